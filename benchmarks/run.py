@@ -0,0 +1,213 @@
+"""Synthetic data benchmarks of the Loader, Analyse and Valuation stages
+
+    python -m benchmarks.run --sizes sector,district --output new.json --compare old.json
+    python -m benchmarks.run --write-golden golden/     (on a known good commit)
+    python -m benchmarks.run --golden golden/           (on the commit under test)
+
+Every size runs in a fresh process, so its peak RSS is its own. Sales are
+generated, written as a snapshot and loaded by Loader, aggregated by
+Analyse with the frame injected in place of Postgres and Mongo, and
+valued by Valuation from the resulting price indices.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import subprocess
+import tempfile
+from datetime import datetime
+from typing import Dict, List
+
+for name in ["POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_HOST", "MONGO_HOST", "MONGO_USERNAME",
+             "MONGO_PASSWORD", "CELERY_BROKER_URL", "CELERY_RESULT_BACKEND"]:
+    os.environ.setdefault(name, "benchmark")
+
+import numpy as np
+import polars as pl
+from worker.analyse import Analyse
+from worker.cache_format import encode_price_index, encode_stats
+from worker.loader import Loader
+from worker.profiler import Profiler, peak_rss
+from worker.snapshot import Snapshot
+from worker.valuation import Valuation
+
+from benchmarks.synthetic import (LAST_UPDATED, NEW_BUILD_SIZES, SIZES,
+                                  SettingsCursor, generate_sales,
+                                  write_snapshot)
+
+AREA_TYPES = ["town", "county", "area", "outcode", "sector"]
+VALUATIONS = 1000
+TOLERANCE = 1e-9
+
+
+def analyse(data: pl.DataFrame, timer: Profiler) -> Analyse:
+    aggregator = object.__new__(Analyse)
+    aggregator._cur = SettingsCursor()
+    aggregator._data = data.select(["price", "date", "type", "houseid"]) \
+        .with_columns(pl.col("type").cast(pl.Categorical))
+    aggregator.timer = timer
+    aggregator.aggregate_data()
+    return aggregator
+
+
+def price_index(aggregator: Analyse, area: str, area_type: str) -> Dict:
+    return {
+        "area": area,
+        "area_type": area_type,
+        "index": {key: np.asarray(values) for key, values in aggregator._price_index["index"].items()},
+        "qty": {key: np.asarray(values) for key, values in aggregator._price_index["qty"].items()},
+    }
+
+
+def run_case(size: str, sales: int, seed: int) -> Dict:
+    cursor = SettingsCursor()
+    timer = Profiler("benchmark", size)
+    with timer.span("generate"):
+        df = generate_sales(sales, seed, resales=size not in NEW_BUILD_SIZES)
+        timer.record_frame(df)
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = Snapshot(directory, cursor, "", LAST_UPDATED)
+        with timer.span("snapshot_write"):
+            write_snapshot(df, snapshot._path)
+        with timer.span("loader"):
+            data = Loader("", "", cursor, "", snapshot=snapshot).get_data()
+            timer.record_frame(data)
+
+    aggregator = analyse(data, timer)
+    with timer.span("encode"):
+        encode_stats(aggregator.stats)
+        encode_price_index(aggregator._price_index)
+
+    house = df.row(0, named=True)
+    setup = Profiler("benchmark_setup", size)
+    aggs = [
+        price_index(analyse(df.filter(pl.col(area_type) == house[area_type]), setup), house[area_type], area_type)
+            for area_type in AREA_TYPES
+    ]
+    aggs.append(price_index(aggregator, "ALL", "COUNTRY"))
+    houses = df.select(["houseid", "type"]).unique(subset="houseid", maintain_order=True).head(VALUATIONS)
+    sales = df.filter(pl.col("houseid").is_in(houses.get_column("houseid"))) \
+        .groupby("houseid") \
+        .agg([pl.col("price"), pl.col("date")]) \
+        .rows()
+    sales = {houseid: list(zip(prices, dates)) for houseid, prices, dates in sales}
+
+    valuer = object.__new__(Valuation)
+    valuer.timer = timer
+    valuations = {}
+    with timer.span("valuation"):
+        for houseid, house_type in houses.rows():
+            valuer._house_info = (houseid, None, None, None, house_type) + tuple(house[key] for key in ["town", "district", "county", "area", "outcode", "sector"])
+            index = valuer.find_house_index(aggs)
+            valuations[houseid] = valuer.calculate_range(valuer.calc_latest_price(sales[houseid], index))
+        timer.record(rows=len(valuations))
+    timer.finish()
+
+    return {
+        "size": size,
+        "sales": len(df),
+        "peak_rss": peak_rss(),
+        "stages": timer.get_times,
+        "outputs": json.loads(json.dumps({"stats": aggregator.stats, "valuations": valuations}, default=str)),
+    }
+
+
+def diff_outputs(golden, output, path: str = "") -> List[str]:
+    if isinstance(golden, dict) and isinstance(output, dict):
+        if set(golden) != set(output):
+            return [f"{path}: keys {sorted(set(golden) ^ set(output))}"]
+        return [line for key in golden for line in diff_outputs(golden[key], output[key], f"{path}/{key}")]
+    if isinstance(golden, list) and isinstance(output, list):
+        if len(golden) != len(output):
+            return [f"{path}: length {len(golden)} != {len(output)}"]
+        return [line for i, (a, b) in enumerate(zip(golden, output)) for line in diff_outputs(a, b, f"{path}[{i}]")]
+    if isinstance(golden, float) and isinstance(output, (float, int)):
+        if not math.isclose(golden, output, rel_tol=TOLERANCE, abs_tol=TOLERANCE):
+            return [f"{path}: {golden} != {output}"]
+        return []
+    if golden != output:
+        return [f"{path}: {golden!r} != {output!r}"]
+    return []
+
+
+def golden_path(directory: str, size: str, seed: int) -> str:
+    return os.path.join(directory, f"{size}-{seed}.json")
+
+
+def print_stages(stages: Dict, indent: int = 2) -> None:
+    for name, stage in stages.items():
+        print(f"{' ' * indent}{name:<{40 - indent}} {stage['time']:>10.4f}s {stage['count']:>6}x "
+              f"{stage['rows']:>12} rows {stage['bytes'] / 1e6:>10.1f} MB {stage['rss'] / 1e6:>8.0f} MB rss "
+              f"{stage['rss_growth'] / 1e6:>+8.0f} MB")
+        print_stages(stage.get("spans", {}), indent + 2)
+
+
+def compare(old: Dict, new: Dict) -> None:
+    print(f"{'size':<10} {'stage':<30} {'old':>10} {'new':>10} {'change':>8}")
+    for size, case in new["cases"].items():
+        if size not in old["cases"]:
+            continue
+        old_case = old["cases"][size]
+        for name, stage in case["stages"].items():
+            if name in old_case["stages"]:
+                before = old_case["stages"][name]["time"]
+                print(f"{size:<10} {name:<30} {before:>10.4f} {stage['time']:>10.4f} {stage['time'] / before - 1:>+8.1%}")
+        print(f"{size:<10} {'peak_rss (MB)':<30} {old_case['peak_rss'] / 1e6:>10.0f} {case['peak_rss'] / 1e6:>10.0f} "
+              f"{case['peak_rss'] / old_case['peak_rss'] - 1:>+8.1%}")
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="new_build,postcode,sector,district",
+                        help=f"comma separated sizes from {', '.join(SIZES)} or sale counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare stage times with")
+    parser.add_argument("--write-golden", help="directory to write the outputs of each size to")
+    parser.add_argument("--golden", help="directory of outputs to check each size against")
+    args = parser.parse_args()
+
+    results = {"commit": git_commit(), "date": datetime.now().isoformat(), "seed": args.seed, "cases": {}}
+    failures = 0
+    context = multiprocessing.get_context("spawn")
+    for size in args.sizes.split(","):
+        sales = SIZES[size] if size in SIZES else int(size)
+        with context.Pool(1) as pool:
+            case = pool.apply(run_case, (size, sales, args.seed))
+        outputs = case.pop("outputs")
+        results["cases"][size] = case
+        print(f"{size}: {case['sales']} sales, peak rss {case['peak_rss'] / 1e6:.0f} MB")
+        print_stages(case["stages"])
+
+        if args.write_golden:
+            os.makedirs(args.write_golden, exist_ok=True)
+            with open(golden_path(args.write_golden, size, args.seed), "w") as f:
+                json.dump(outputs, f)
+        if args.golden:
+            with open(golden_path(args.golden, size, args.seed)) as f:
+                differences = diff_outputs(json.load(f), outputs)
+            print(f"  golden: {len(differences)} differences")
+            for line in differences[:20]:
+                print(f"    {line}")
+            failures += len(differences) > 0
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,15 +1,21 @@
 
-import time
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 import sentry_sdk
 from sentry_sdk.integrations.celery import CeleryIntegration
 from worker.analyse import Analyse
-from worker.config import manage_sensitive
+from worker.cache_format import migrate_cache
+from worker.config import Config, manage_sensitive
+from worker.connections import Connections
+from worker.profiler import mark_process_dead, start_metrics_server
+from worker.routing import (MAINTENANCE, QUEUES, STANDARD, larger_queue,
+                            priority, route_task)
+from worker.settings import Settings
+from worker.snapshot import Snapshot
 from worker.valuation import Valuation
 
-from celery import Celery, group, signals
-from celery.result import allow_join_result
+from celery import Celery, chord, group, signals
+from kombu import Queue
 
 # Initialize Celery
 celery = Celery(
@@ -19,6 +25,15 @@ celery = Celery(
     task_ingnore_result= True,
     task_acks_late = True,
     worker_prefetch_multiplier= 1,
+    task_default_queue = STANDARD,
+    task_routes = (route_task,),
+    task_queues = [
+        Queue(queue) if queue == STANDARD else Queue(queue, queue_arguments={"x-max-priority": 10})
+            for queue in QUEUES + [MAINTENANCE]
+    ],
+    task_default_priority = priority(3),
+    broker_transport_options = {"queue_order_strategy": "priority", "priority_steps": list(range(10))},
+    worker_max_memory_per_child = Config.WORKER_MAX_MEMORY_MB * 1024 or None,
 )
 
 @signals.celeryd_init.connect
@@ -32,43 +47,144 @@ def init_sentry(**_kwargs):
             ]
         )
 
-@celery.task(name="worker.analyse")
-def analyse_task(area: str, area_type: str):
+@signals.celeryd_init.connect
+def init_metrics(**_kwargs):
+    if Config.METRICS_PORT > 0:
+        start_metrics_server(Config.METRICS_PORT)
+
+@signals.worker_process_init.connect
+def open_connections(**_kwargs):
+    Connections.open()
+
+@signals.worker_process_shutdown.connect
+def close_connections(pid: int | None = None, **_kwargs):
+    Connections.close()
+    if pid is not None:
+        mark_process_dead(pid)
+
+@signals.task_postrun.connect
+def release_connections(**_kwargs):
+    Connections.release_all()
+
+@celery.task(name="worker.analyse", bind=True)
+def analyse_task(self, area: str, area_type: str, rollup: bool = False):
     area = area.upper()
     area_type = area_type.upper()
     aggregator = Analyse()
+    queue = larger_queue(aggregator.cursor, area, area_type, (self.request.delivery_info or {}).get("routing_key"))
+    if queue is not None:
+        aggregator.clean_up()
+        return self.replace(analyse_task.si(area, area_type, rollup).set(queue=queue, priority=priority(3)))
     if area == "ALL" and area_type == "COUNTRY":
-        aggregator.run(area, area_type)
+        aggregator.run(area, area_type, rollup=True)
     else:
-        aggregator.run(area, area_type)
+        aggregator.run(area, area_type, rollup=rollup)
     aggregator.clean_up()
     return area + area_type
 
-@celery.task(name="worker.valuation")
-def valuation_task(houseid: str):
+@celery.task(name="worker.analyse_batch")
+def analyse_batch_task(area_type: str):
+    aggregator = Analyse()
+    count = aggregator.run_batch(area_type)
+    aggregator.clean_up()
+    return count
+
+@celery.task(name="worker.analyse_areas")
+def analyse_areas_task(areas: List[Tuple[str, str]], rollup: bool = False):
+    return Analyse.run_many(areas, rollup=rollup)
+
+@celery.task(name="worker.valuation", bind=True)
+def valuation_task(self, houseid: str):
     valuater = Valuation()
-    if valuater.check_house(houseid):
+    try:
+        if valuater.check_house(houseid):
+            missing = valuater.stale_areas(valuater.get_areas() + [("ALL", "COUNTRY")])
+            if len(missing) > 0:
+                analyses = [analyse_task.si(*area) for area in missing]
+                return self.replace(chord(analyses, valuation_callback_task.si(houseid)))
+            return value_house(valuater)
+        else:
+            return "No House Found"
+    finally:
+        valuater.clean_up()
+
+@celery.task(name="worker.valuation_callback")
+def valuation_callback_task(houseid: str):
+    valuater = Valuation()
+    try:
+        if valuater.check_house(houseid):
+            return value_house(valuater)
+        else:
+            return "No House Found"
+    finally:
+        valuater.clean_up()
+
+@celery.task(name="worker.valuation_batch", bind=True)
+def valuation_batch_task(self, houseids: List[str]):
+    valuater = Valuation("valuation_batch")
+    try:
+        houses = valuater.check_houses(houseids)
+        areas = {area for house_info in houses.values() for area in valuater.get_areas(house_info)}
+        missing = valuater.stale_areas(list(areas) + [("ALL", "COUNTRY")])
+        if len(missing) > 0:
+            analyses = [analyse_task.si(*area) for area in missing]
+            return self.replace(chord(analyses, valuation_batch_callback_task.si(houseids)))
+        return value_houses(valuater, houseids, houses)
+    finally:
+        valuater.clean_up()
+
+@celery.task(name="worker.valuation_batch_callback")
+def valuation_batch_callback_task(houseids: List[str]):
+    valuater = Valuation("valuation_batch")
+    try:
+        return value_houses(valuater, houseids, valuater.check_houses(houseids))
+    finally:
+        valuater.clean_up()
+
+def value_houses(valuater: Valuation, houseids: List[str], houses: Dict[str, Tuple]) -> Dict:
+    valuations = valuater.value_houses(houses)
+    return {
+        houseid: valuations.get(houseid, "No House Found") for houseid in houseids
+    }
+
+def value_house(valuater: Valuation) -> Dict:
+    with valuater.timer.span("load_aggregations"):
         areas = valuater.get_areas()
-        get_analysis_of_areas(areas)
         aggs = valuater.load_aggregations(areas)
-        perc_changes = valuater.find_monthly_averages(aggs)
+    with valuater.timer.span("house_index"):
+        index = valuater.find_house_index(aggs)
+    with valuater.timer.span("load_sales"):
         sales = valuater.get_house_sales()
-        valuations = valuater.calc_latest_price(sales, perc_changes)
+        valuater.timer.record(rows=len(sales))
+    with valuater.timer.span("value"):
+        valuations = valuater.calc_latest_price(sales, index)
         price_range = valuater.calculate_range(valuations)
-        return {
-            "price_range": price_range,
-        }
-    else:
-        return "No House Found"
+    return {
+        "price_range": price_range,
+    }
+
+@celery.task(name="worker.build_snapshot")
+def build_snapshot_task():
+    if not Config.SNAPSHOT_DIR:
+        return False
+    conn = Connections.get_sql()
+    try:
+        with conn.cursor() as cur:
+            snapshot = Snapshot(Config.SNAPSHOT_DIR, cur, Connections.sql_uri(), Settings.last_updated(cur))
+            snapshot.build()
+            return snapshot.ready
+    finally:
+        Connections.put_sql(conn)
+
+@celery.task(name="worker.migrate_cache")
+def migrate_cache_task():
+    return migrate_cache(Connections.mongo().house_data.cache)
 
 @celery.task(name="worker.analyse_multiple")
-def get_analysis_of_areas(areas: List[Tuple[str,str]]) -> None:
+def get_analysis_of_areas(areas: List[Tuple[str,str]]) -> str:
     tasks = []
     for area in areas:
         tasks.append(analyse_task.subtask(area))
     tasks = group(tasks)
     job = tasks.apply_async()
-    while not job.ready():
-        time.sleep(0.2)
-    with allow_join_result():
-        results = job.get()
+    return job.id
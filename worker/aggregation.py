@@ -0,0 +1,138 @@
+from datetime import datetime
+from typing import Dict, List
+
+import polars as pl
+
+TENANCY_BINS = 30
+YEAR_US = 31_557_600_000_000
+HOLDING_COLUMNS = [f"held_{year}" for year in range(TENANCY_BINS)]
+MONTHLY_COLUMNS = ["type", "date", "qty", "volume", "log_price", "max_price"]
+HOUSE_COLUMNS = ["type", "houses", "holdings", "tenancy"] + HOLDING_COLUMNS
+CELL_COLUMNS = ["area", "outcode", "sector", "district", "county", "town"]
+COLUMN_TYPES = {
+    "date": pl.Datetime("us"),
+    "qty": pl.Int64,
+    "volume": pl.Int64,
+    "log_price": pl.Float64,
+    "max_price": pl.Int64,
+    "houses": pl.Int64,
+    "holdings": pl.Int64,
+    "tenancy": pl.Int64,
+    **{column: pl.Int64 for column in HOLDING_COLUMNS}
+}
+
+
+def monthly_stats(df: pl.DataFrame, by: List[str] | None = None) -> pl.DataFrame:
+    """Per type, per month sufficient statistics of date sorted sales
+
+    qty, volume and log_price add up and max_price maxes up across months,
+    types and areas, so any coarser series can be rebuilt from these rows.
+    """
+    keys = (by or []) + ["type"]
+    return df.lazy() \
+        .groupby_dynamic("date", every="1mo", by=keys) \
+        .agg([
+            pl.col("price").count().cast(pl.Int64).alias("qty"),
+            pl.col("price").sum().cast(pl.Int64).alias("volume"),
+            pl.col("price").log().sum().alias("log_price"),
+            pl.col("price").max().cast(pl.Int64).alias("max_price"),
+        ]) \
+        .with_columns(pl.col("type").cast(pl.Utf8)) \
+        .select((by or []) + MONTHLY_COLUMNS) \
+        .collect()
+
+
+def merge_monthly(df: pl.DataFrame, by: List[str] | None = None) -> pl.DataFrame:
+    keys = (by or []) + ["type", "date"]
+    return df.lazy() \
+        .groupby(keys) \
+        .agg([
+            pl.col("qty").sum(),
+            pl.col("volume").sum(),
+            pl.col("log_price").sum(),
+            pl.col("max_price").max(),
+        ]) \
+        .select((by or []) + MONTHLY_COLUMNS) \
+        .sort("date") \
+        .collect()
+
+
+def house_stats(df: pl.DataFrame, by: List[str] | None = None) -> pl.DataFrame:
+    """Per type house counts and holding periods of date sorted sales, in one pass
+
+    Each sale after a house's first ends a holding period of its diff from
+    the sale before, so houses count the null diffs and holdings the rest.
+    The periods of a house add up to its last sale date minus its first, so
+    the mean tenancy is tenancy / holdings, in microseconds, and held_n
+    counts the holdings of n whole years, the last bin open ended.
+    """
+    keys = (by or []) + ["type"]
+    held = pl.col("date").dt.timestamp("us").diff().over("houseid")
+    return _house_totals(df.lazy().select(keys + [held.alias("held")]), keys)
+
+
+def _house_totals(df: pl.LazyFrame, keys: List[str]) -> pl.DataFrame:
+    years = (pl.col("held") // YEAR_US).clip_max(TENANCY_BINS - 1)
+    return df \
+        .groupby(keys) \
+        .agg([
+            pl.col("held").is_null().sum().alias("houses"),
+            pl.col("held").is_not_null().sum().alias("holdings"),
+            pl.col("held").sum().alias("tenancy"),
+        ] + [
+            (years == year).sum().alias(column)
+                for year, column in enumerate(HOLDING_COLUMNS)
+        ]) \
+        .with_columns([pl.col("type").cast(pl.Utf8), pl.col(["tenancy"] + HOLDING_COLUMNS).fill_null(0)]) \
+        .with_columns([pl.col(column).cast(pl.Int64) for column in HOUSE_COLUMNS[1:]]) \
+        .select(keys[:-1] + HOUSE_COLUMNS) \
+        .sort(keys) \
+        .collect()
+
+
+def merge_houses(df: pl.DataFrame, by: List[str] | None = None) -> pl.DataFrame:
+    keys = (by or []) + ["type"]
+    return df.lazy() \
+        .groupby(keys) \
+        .agg([pl.col(column).sum() for column in HOUSE_COLUMNS[1:]]) \
+        .select((by or []) + HOUSE_COLUMNS) \
+        .sort(keys) \
+        .collect()
+
+
+def house_increment(df: pl.DataFrame, by: List[str] | None = None) -> pl.DataFrame:
+    """House totals added by new date sorted sales, given each house's prev_date
+
+    prev_date is the house's last sale before the new ones, or null for a
+    house which had not sold before, so the first new sale of a house which
+    had ends the holding period since then.
+    """
+    date = pl.col("date").dt.timestamp("us")
+    keys = (by or []) + ["type"]
+    held = date.diff().over("houseid").fill_null(date - pl.col("prev_date").dt.timestamp("us"))
+    return _house_totals(df.lazy().select(keys + [held.alias("held")]), keys)
+
+
+def stale_months(monthly: pl.DataFrame, totals: pl.DataFrame, by: List[str] | None = None) -> List[datetime]:
+    """Months before the cut-off whose totals no longer match the database"""
+    keys = (by or []) + ["type", "date"]
+    df = monthly \
+        .select(keys + ["qty", "volume"]) \
+        .join(totals, on=keys, how="outer") \
+        .fill_null(0) \
+        .filter(
+            (pl.col("qty") != pl.col("qty_right"))
+            | (pl.col("volume") != pl.col("volume_right"))
+        )
+    return df.get_column("date").unique().sort().to_list()
+
+
+def encode_frame(df: pl.DataFrame) -> Dict:
+    return df.to_dict(as_series=False)
+
+
+def decode_frame(data: Dict) -> pl.DataFrame:
+    df = pl.DataFrame(data)
+    return df.with_columns([
+        pl.col(column).cast(COLUMN_TYPES.get(column, pl.Utf8)) for column in df.columns
+    ])
@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Set, Tuple
+
+from worker.config import Config
+
+
+class AggregationCache():
+    """Per process LRU of the decoded price index slices Valuation reads
+
+    An entry holds the index and monthly sales of the types requested so far
+    in one area. Entries expire after ttl seconds, the least recently used
+    are evicted past max_bytes, and everything is dropped when last_updated
+    moves on. Only slices of documents as new as last_updated are kept, so a
+    cached area is also known to be fresh.
+    """
+    ttl = Config.VALUATION_CACHE_TTL
+    max_bytes = Config.VALUATION_CACHE_MB * 1024 * 1024
+    _entries: OrderedDict[str, Tuple[float, Set[str], Dict]] = OrderedDict()
+    _sizes: Dict[str, int] = {}
+    _size = 0
+    _last_updated: datetime | None = None
+
+    @classmethod
+    def check(cls, last_updated: datetime) -> None:
+        if cls._last_updated != last_updated:
+            cls.clear()
+            cls._last_updated = last_updated
+
+    @classmethod
+    def clear(cls) -> None:
+        cls._entries.clear()
+        cls._sizes.clear()
+        cls._size = 0
+
+    @classmethod
+    def contains(cls, _id: str) -> bool:
+        entry = cls._entries.get(_id)
+        if entry is None:
+            return False
+        if time.monotonic() - entry[0] >= cls.ttl:
+            cls._remove(_id)
+            return False
+        return True
+
+    @classmethod
+    def get(cls, _id: str, house_types: Set[str]) -> Dict | None:
+        if not cls.contains(_id):
+            return None
+        _, loaded, agg = cls._entries[_id]
+        if not house_types <= loaded:
+            return None
+        cls._entries.move_to_end(_id)
+        return agg
+
+    @classmethod
+    def put(cls, _id: str, agg: Dict, house_types: Set[str]) -> None:
+        stamp = time.monotonic()
+        if cls.contains(_id):
+            stamp, loaded, cached = cls._entries[_id]
+            agg = {
+                **agg,
+                "index": {**cached["index"], **agg["index"]},
+                "qty": {**cached["qty"], **agg["qty"]}
+            }
+            house_types = house_types | loaded
+            cls._remove(_id)
+        size = sum(values.nbytes for name in ["index", "qty"] for values in agg[name].values())
+        cls._entries[_id] = (stamp, house_types, agg)
+        cls._sizes[_id] = size
+        cls._size += size
+        while cls._size > cls.max_bytes and len(cls._entries) > 1:
+            cls._remove(next(iter(cls._entries)))
+
+    @classmethod
+    def _remove(cls, _id: str) -> None:
+        del cls._entries[_id]
+        cls._size -= cls._sizes.pop(_id)
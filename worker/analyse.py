@@ -1,39 +1,195 @@
+import threading
+from collections import deque
 from datetime import datetime, timedelta
-from typing import Dict
+from functools import partial
+from typing import Callable, Deque, Dict, List, Tuple
 
 import polars as pl
-import psycopg2
-from dateutil.relativedelta import relativedelta
 from polars import exceptions as pl_ex
-from pymongo import MongoClient
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError
+from worker.aggregation import (HOLDING_COLUMNS, HOUSE_COLUMNS, decode_frame,
+                                encode_frame, house_increment, house_stats,
+                                merge_houses, merge_monthly, monthly_stats,
+                                stale_months)
+from worker.cache_format import (CACHE_VERSION, encode_price_index,
+                                 encode_stats)
 from worker.config import Config
-from worker.func_timer import Timer
-from worker.loader import Loader
+from worker.connections import Connections
+from worker.loader import (AggregateLoader, BatchLoader, IncrementLoader,
+                           Loader, StreamLoader)
+from worker.pipeline import BackgroundWriter, prefetch
+from worker.postcode_index import postcode_areas
+from worker.profiler import Profiler, merge_spans
+from worker.rollup import Rollup
+from worker.routing import SizeEstimate
+from worker.settings import Settings
+from worker.single_flight import SingleFlight
+from worker.snapshot import Snapshot
+
+PERIODS = ["1mo", "3mo", "6mo", "12mo"]
+STATUS_KEYS = PERIODS + ["houses"]
 
 
 class Analyse():
     def __init__(self):
         config = Config()
-        self._sql_uri = f"postgresql://{config.SQL_USER}:{config.SQL_PASSWORD}@{config.SQL_HOST}:5432/house_data"
-        self._sql_db = psycopg2.connect(self._sql_uri)
-        self._mongo_db = MongoClient(f"mongodb://{config.MONGO_USER}:{config.MONGO_PASSWORD}@{config.MONGO_HOST}:27017/?authSource=house_data")
+        self._sql_uri = Connections.sql_uri()
+        self._partitions = config.LOADER_PARTITIONS
+        self._snapshot_dir = config.SNAPSHOT_DIR
+        self._stream_memory = config.STREAM_MEMORY_MB
+        self._pushdown = config.PUSHDOWN_AREA_TYPES
+        self._progressive = config.PROGRESSIVE_PUBLISH
+        self._pipeline_depth = min(config.PIPELINE_DEPTH, config.SQL_POOL_SIZE - 1)
+        self._pipeline_writes = config.PIPELINE_WRITES
+        self._writer: BackgroundWriter | None = None
+        self._sql_db = Connections.get_sql()
+        self._mongo_db = Connections.mongo()
         self._cur = self._sql_db.cursor()
         self._mongo = self._mongo_db.house_data
+        self._data = None
+        self._cutoff = None
 
     @property
     def cursor(self):
         return self._cur
 
     def clean_up(self):
-        self._sql_db.close()
-        self._mongo_db.close()
+        self._cur.close()
+        Connections.put_sql(self._sql_db)
 
-    def run(self, area: str, area_type: str):
+    def run(self, area: str, area_type: str, rollup: bool = False):
         area = area.upper()
         area_type = area_type.upper()
-        self.timer = Timer()
+        self.timer = Profiler("analyse", area_type)
         try:
-            data = self.load_data(area, area_type)
+            self._run(area, area_type, rollup)
+        finally:
+            self.timer.finish()
+
+    def _run(self, area: str, area_type: str, rollup: bool):
+        flight = self._claim(area, area_type)
+        if flight is None:
+            return
+        try:
+            if self._load(area, area_type, rollup):
+                self._publish(area, area_type)
+        finally:
+            flight.release()
+
+    @classmethod
+    def run_many(cls, areas: List[Tuple[str, str]], rollup: bool = False) -> int:
+        """Analyses several areas as a pipeline
+
+        Each area gets its own Analyse, which is claimed and loaded on a
+        thread up to PIPELINE_DEPTH areas ahead while the current one
+        aggregates, and the cache writes go through a background writer of
+        PIPELINE_WRITES pending writes. Throughput is then bound by the
+        slower of the database and the CPU rather than by both together.
+        An area's lease is released once its writes have run, or on the way
+        out for areas that are never reached. Every area is attempted and the
+        first error is raised at the end.
+        """
+        config = Config()
+        depth = min(config.PIPELINE_DEPTH, config.SQL_POOL_SIZE - 1)
+        writer = BackgroundWriter(config.PIPELINE_WRITES)
+        areas = [(area.upper(), area_type.upper()) for area, area_type in areas]
+        fetched = prefetch(areas, partial(cls._prefetch_area, rollup=rollup), depth, discard=cls._abandon)
+        releases: Deque[Tuple[threading.Event, SingleFlight]] = deque()
+        count = 0
+        error = None
+        try:
+            for (area, area_type), (aggregator, fetch_error) in fetched:
+                try:
+                    if fetch_error is not None:
+                        raise fetch_error
+                    if aggregator._loaded:
+                        aggregator._writer = writer
+                        aggregator._publish(area, area_type)
+                        count += 1
+                except Exception as e:
+                    print(e)
+                    error = error or e
+                finally:
+                    if aggregator is not None:
+                        if aggregator._flight is not None:
+                            releases.append((writer.flushed(), aggregator._flight))
+                        aggregator.timer.finish()
+                        aggregator.clean_up()
+                    while len(releases) > 0 and releases[0][0].is_set():
+                        releases.popleft()[1].release()
+        finally:
+            fetched.close()
+            try:
+                writer.close()
+            except Exception as e:
+                print(e)
+                error = error or e
+            finally:
+                for _, flight in releases:
+                    flight.release()
+        if error is not None:
+            raise error
+        return count
+
+    @classmethod
+    def _prefetch_area(cls, area: Tuple[str, str], rollup: bool) -> Tuple["Analyse | None", Exception | None]:
+        """The claimed and loaded Analyse of an area, with the error that stopped it if any"""
+        area, area_type = area
+        try:
+            aggregator = cls()
+        except Exception as e:
+            return None, e
+        aggregator.timer = Profiler("analyse_many", area_type)
+        aggregator._flight = None
+        aggregator._loaded = False
+        try:
+            aggregator._flight = aggregator._claim(area, area_type)
+            if aggregator._flight is not None:
+                rollup = rollup or (area == "ALL" and area_type == "COUNTRY")
+                aggregator._loaded = aggregator._load(area, area_type, rollup)
+        except Exception as e:
+            return aggregator, e
+        return aggregator, None
+
+    @staticmethod
+    def _abandon(fetched: Tuple["Analyse | None", Exception | None]) -> None:
+        """Lets go of an area prefetched by run_many which it never reached"""
+        aggregator, _ = fetched
+        if aggregator is None:
+            return
+        try:
+            if aggregator._flight is not None:
+                aggregator._flight.release()
+        finally:
+            aggregator.clean_up()
+
+    def _claim(self, area: str, area_type: str) -> SingleFlight | None:
+        """The lease to analyse the area, None once it is cached"""
+        with self.timer.span("check_cache"):
+            cached = self._check_cache(area + area_type)
+        self.timer.set_cache(cached)
+        if cached:
+            return None
+
+        flight = SingleFlight(Connections.redis(), area + area_type)
+        with self.timer.span("single_flight"):
+            while not flight.acquire():
+                if not flight.wait():
+                    print(f"Timed out waiting on {area + area_type}, analysing it anyway")
+                    break
+                if self._check_cache(area + area_type):
+                    self.timer.set_cache(True)
+                    return None
+        return flight
+
+    def _load(self, area: str, area_type: str, rollup: bool) -> bool:
+        """Loads the area, True if it has sales to aggregate"""
+        try:
+            if rollup:
+                data = self.load_rollup(area, area_type)
+            else:
+                data = self.load_data(area, area_type)
         except RuntimeError:
             return_data = {
                 "_id": area + area_type,
@@ -41,13 +197,18 @@ class Analyse():
                 "area_type": area_type,
                 "last_updated": datetime.now(),
                 "timings": {},
-                "stats": {}
+                "version": CACHE_VERSION,
+                "stats": {},
+                "price_index": {}
             }
-            self._cache_results(return_data)
+            self._write(self._cache_results, return_data)
+            return False
+        return not data
 
-        if (not self._check_cache(area + area_type) 
-                and not data):
-    
+    def _publish(self, area: str, area_type: str) -> None:
+        if self._progressive:
+            self.publish_progressive(area, area_type)
+        else:
             self.aggregate_data()
 
             timings = self.timer.get_times
@@ -58,32 +219,289 @@ class Analyse():
                 "area_type": area_type,
                 "last_updated": datetime.now(),
                 "timings": timings,
-                "stats": self._stats
+                "version": CACHE_VERSION,
+                "status": {key: "ready" for key in STATUS_KEYS},
+                "stats": encode_stats(self._stats),
+                "price_index": encode_price_index(self._price_index)
             }
 
-            self._cache_results(return_data)
+            self._write(self._cache_results, return_data)
+        if self._cutoff is not None:
+            self._cache_state(area + area_type)
+
+    def run_batch(self, area_type: str, chunk_size: int = 500) -> int:
+        """Caches the stats of every area of area_type from one pass over the sales"""
+        area_type = area_type.upper()
+        column = area_type.lower()
+        self.timer = Profiler("analyse_batch", area_type)
+        try:
+            return self._run_batch(area_type, column, chunk_size)
+        finally:
+            self.timer.finish()
+
+    def _run_batch(self, area_type: str, column: str, chunk_size: int) -> int:
+        self.timer.start("loader")
+        snapshot = self._get_snapshot()
+        cutoff = self.latest_date
+        monthly = []
+        houses = []
+        fetch = partial(self._fetch_batch, area_type=area_type, column=column, snapshot=snapshot)
+        for _, data in prefetch(postcode_areas(self._cur), fetch, self._pipeline_depth):
+            self.timer.record_frame(data)
+            if len(data) > 0:
+                monthly.append(monthly_stats(data, by=[column]))
+                houses.append(house_stats(data, by=[column]))
+        if len(monthly) == 0:
+            self.timer.end("loader")
+            return 0
+        monthly = merge_monthly(pl.concat(monthly), by=[column]).partition_by(column, as_dict=True)
+        houses = merge_houses(pl.concat(houses), by=[column]).partition_by(column, as_dict=True)
+        self.timer.end("loader")
+
+        self._writer = BackgroundWriter(self._pipeline_writes)
+        try:
+            self._publish_batch(area_type, column, chunk_size, monthly, houses, cutoff)
+        finally:
+            writer, self._writer = self._writer, None
+            writer.close()
+        return len(monthly)
+
+    def _fetch_batch(self, chunk: str, area_type: str, column: str, snapshot: Snapshot | None) -> pl.DataFrame:
+        """Sales of one postcode area, with a cursor of its own as it runs on a prefetch thread"""
+        with self._sql_db.cursor() as cur:
+            loader = BatchLoader(area_type, chunk, cur, self._sql_uri, snapshot=snapshot)
+            return loader.get_data().filter(pl.col(column).is_not_null())
+
+    def _publish_batch(self, area_type: str, column: str, chunk_size: int, monthly: Dict[str, pl.DataFrame],
+                       houses: Dict[str, pl.DataFrame], cutoff: datetime | None) -> None:
+        cache_writes = []
+        state_writes = []
+        for area in monthly:
+            self._data = None
+            self._monthly = monthly[area].drop(column)
+            self._houses = houses[area].drop(column)
+            self._cutoff = cutoff
+            with self.timer.span("area") as span:
+                self.aggregate_data()
+            area_id = area.upper() + area_type
+            cache_writes.append(ReplaceOne({"_id": area_id}, {
+                "_id": area_id,
+                "area": area.upper(),
+                "area_type": area_type,
+                "last_updated": datetime.now(),
+                "timings": merge_spans(span.children),
+                "version": CACHE_VERSION,
+                "status": {key: "ready" for key in STATUS_KEYS},
+                "stats": encode_stats(self._stats),
+                "price_index": encode_price_index(self._price_index)
+            }, upsert=True))
+            state_writes.append(ReplaceOne({"_id": area_id}, self._state_record(area_id), upsert=True))
+            if len(cache_writes) >= chunk_size:
+                self._write(self._mongo.cache.bulk_write, cache_writes, ordered=False)
+                self._write(self._mongo.state.bulk_write, state_writes, ordered=False)
+                cache_writes = []
+                state_writes = []
+        if len(cache_writes) > 0:
+            self._write(self._mongo.cache.bulk_write, cache_writes, ordered=False)
+            self._write(self._mongo.state.bulk_write, state_writes, ordered=False)
 
     def load_data(self, area, area_type):
+        state = self._mongo.state.find_one({"_id": area + area_type})
+        if state is not None:
+            return self.load_increment(area, area_type, state)
+
         if area == "ALL" and area_type == "COUNTRY":
             area = ""
             area_type = ""
+        if (area_type.lower() or "country") in self._pushdown:
+            return self.load_aggregates(area, area_type)
+        if self._stream_memory > 0 and (area_type == "" or self._over_budget(area, area_type)):
+            return self.load_stream(area, area_type)
 
         self.timer.start("loader")
 
         try:
-            self._loader = Loader(area, area_type, self._cur, self._sql_uri)
+            self._loader = Loader(area, area_type, self._cur, self._sql_uri,
+                                  partitions=self._partitions, snapshot=self._get_snapshot())
         except ValueError as e:
             print(e)
             return e
         self._data = self._loader.get_data()
+        self.timer.record_frame(self._data)
+        self._cutoff = self._loader.latest_date
         del self._loader
 
         self.timer.end("loader")
 
+    def _over_budget(self, area: str, area_type: str) -> bool:
+        """Whether the area's sales would likely take more than the stream memory to load at once"""
+        try:
+            sales = SizeEstimate.sales(self._cur, area, area_type)
+        except ValueError:
+            return False
+        return sales * StreamLoader.row_bytes > self._stream_memory * 1024 * 1024
+
+    def load_stream(self, area, area_type):
+        """Aggregates the sales chunk by chunk instead of loading them all"""
+        self.timer.start("loader")
+        try:
+            loader = StreamLoader(area, area_type, self._sql_db, self._cur, self._stream_memory)
+        except ValueError as e:
+            print(e)
+            return e
+        monthly = None
+        houses = None
+        for chunk in loader.chunks():
+            self.timer.record_frame(chunk)
+            chunk = chunk.sort("date")
+            if monthly is None:
+                monthly = monthly_stats(chunk)
+                houses = house_stats(chunk)
+            else:
+                monthly = merge_monthly(pl.concat([monthly, monthly_stats(chunk)]))
+                houses = merge_houses(pl.concat([houses, house_stats(chunk)]))
+        if monthly is None:
+            raise RuntimeError("No Sales for this area")
+
+        self._data = None
+        self._monthly = monthly
+        self._houses = houses
+        self._cutoff = loader.latest_date
+        del loader
+
+        self.timer.end("loader")
+
+    def load_aggregates(self, area, area_type):
+        """Loads the monthly and house totals aggregated by Postgres instead of the sales"""
+        self.timer.start("loader")
+        try:
+            loader = AggregateLoader(area, area_type, self._cur)
+        except ValueError as e:
+            print(e)
+            return e
+        monthly = loader.monthly_stats()
+        self.timer.record_frame(monthly)
+        if len(monthly) == 0:
+            raise RuntimeError("No Sales for this area")
+
+        self._data = None
+        self._monthly = monthly
+        self._houses = loader.house_totals()
+        self._cutoff = loader.latest_date
+        del loader
+
+        self.timer.end("loader")
+
+    def _get_snapshot(self) -> Snapshot | None:
+        if not self._snapshot_dir:
+            return None
+        snapshot = Snapshot(self._snapshot_dir, self._cur, self._sql_uri, self.last_updated())
+        if snapshot.ready:
+            return snapshot
+        snapshot.request_build()
+
+    def load_increment(self, area, area_type, state: Dict):
+        if area == "ALL" and area_type == "COUNTRY":
+            area = ""
+            area_type = ""
+
+        self.timer.start("loader")
+
+        try:
+            loader = IncrementLoader(area, area_type, self._cur, self._sql_uri, state["cutoff"])
+        except ValueError as e:
+            print(e)
+            return e
+        monthly = decode_frame(state["monthly"])
+        houses = decode_frame(state["houses"])
+        months = stale_months(monthly, loader.monthly_totals())
+        loader.fetch_area_sales(months)
+        data = loader.get_data().sort("date")
+        self.timer.record_frame(data)
+
+        monthly = monthly.filter(~pl.col("date").is_in(months))
+        if len(data) > 0:
+            monthly = merge_monthly(pl.concat([monthly, monthly_stats(data)]))
+        if len(months) > 0 or not set(HOUSE_COLUMNS) <= set(houses.columns):
+            houses = loader.house_totals()
+        elif len(data) > 0:
+            houses = merge_houses(pl.concat([houses, house_increment(data)]))
+        if len(monthly) == 0:
+            raise RuntimeError("No Sales for this area")
+
+        self._data = None
+        self._monthly = monthly
+        self._houses = houses
+        self._cutoff = loader.latest_date
+        del loader
+
+        self.timer.end("loader")
+
+    def load_rollup(self, area, area_type):
+        if (area_type.lower() or "country") in self._pushdown:
+            return self.load_data(area, area_type)
+        if area == "ALL" and area_type == "COUNTRY":
+            area = ""
+            area_type = ""
+        if area_type.lower() not in Rollup.area_types:
+            return self.load_data(area, area_type)
+
+        self.timer.start("rollup")
+        rollup = Rollup(self._cur, self._mongo, self._sql_uri, self.last_updated(), self._stream_memory)
+        self._data = None
+        self._monthly, self._houses = rollup.get_state(area, area_type.lower())
+        self._cutoff = rollup.latest_date
+        self.timer.end("rollup")
+
+    def publish_progressive(self, area: str, area_type: str) -> None:
+        """Aggregates like aggregate_data, publishing each part to the cache as soon as it is ready
+
+        The 1mo stats, with their quick stats and the price index, are written
+        first, replacing any older stats, then 3mo, 6mo and 12mo, then the
+        tenancy and type proportions every period shares. status says which
+        parts are ready, and partial stays set until the last one is.
+        """
+        area_id = area + area_type
+        status = {key: "pending" for key in STATUS_KEYS}
+        self.timer.start("aggregate")
+        self._prepare_monthly()
+        self._stats = {}
+        for period in PERIODS:
+            data = self._period_stats(period=period)
+            data["quick_stats"] = self._quick_stats(data)
+            self._stats[period] = data
+            status[period] = "ready"
+            if period == "1mo":
+                self._price_index = self.get_price_index(data)
+                update = {
+                    "area": area,
+                    "area_type": area_type,
+                    "last_updated": datetime.now(),
+                    "version": CACHE_VERSION,
+                    "partial": True,
+                    "stats": encode_stats({period: data}),
+                    "price_index": encode_price_index(self._price_index)
+                }
+            else:
+                update = {f"stats.{period}": encode_stats({period: data})[period]}
+            self._write(self._mongo.cache.update_one, {"_id": area_id}, {"$set": {**update, "status": dict(status)}}, upsert=True)
+
+        houses = self._house_stats()
+        update = {}
+        for period in PERIODS:
+            self._stats[period].update(houses)
+            update.update({f"stats.{period}.{key}": value for key, value in houses.items()})
+        status["houses"] = "ready"
+        self.timer.end("aggregate")
+        self._write(self._mongo.cache.update_one, {"_id": area_id}, {
+            "$set": {**update, "status": status, "timings": self.timer.get_times},
+            "$unset": {"partial": ""}
+        })
 
     def aggregate_data(self):
         self.timer.start("aggregate")
         self._stats = self.get_all_data()
+        self._price_index = self.get_price_index(self._stats["1mo"])
         self.timer.end("aggregate")
 
     @property
@@ -91,22 +509,38 @@ class Analyse():
         return self._stats
 
     def _cache_results(self, return_data: Dict) -> None:
-        area_record = self._mongo.cache.find_one({
-            "_id": return_data["_id"]
-        })
-        if area_record is not None:
-            self._mongo.cache.update_one(
-                {"_id": return_data["_id"]},
-                {"$set":{
-                        "last_updated": return_data["last_updated"],
-                        "timings": return_data["timings"],
-                        "stats": return_data["stats"]
-                }})
+        fields = {key: value for key, value in return_data.items() if key != "_id"}
+        update = {"$set": fields, "$unset": {"partial": ""}}
+        try:
+            self._mongo.cache.update_one({"_id": return_data["_id"]}, update, upsert=True)
+        except DuplicateKeyError:
+            self._mongo.cache.update_one({"_id": return_data["_id"]}, update)
+
+    def _cache_state(self, area_id: str) -> None:
+        self._write(self._mongo.state.replace_one, {"_id": area_id}, self._state_record(area_id), upsert=True)
+
+    def _write(self, write: Callable, *args, **kwargs) -> None:
+        """Runs a cache write, on the background writer when there is one"""
+        if self._writer is not None:
+            self._writer.submit(write, *args, **kwargs)
         else:
-            self._mongo.cache.insert_one(return_data)
+            write(*args, **kwargs)
+
+    def _state_record(self, area_id: str) -> Dict:
+        return {
+            "_id": area_id,
+            "cutoff": self._cutoff,
+            "last_updated": datetime.now(),
+            "monthly": encode_frame(self._monthly),
+            "houses": encode_frame(self._houses)
+        }
 
     def _check_cache(self, area_id: str) -> bool:
-        data = self._mongo.cache.find_one({"_id": area_id})
+        data = self._mongo.cache.find_one({
+            "_id": area_id,
+            "price_index": {"$exists": True},
+            "partial": {"$ne": True}
+        }, {"last_updated": 1})
         if data is not None:
             last_updated = self.last_updated()
             if data["last_updated"] < last_updated:
@@ -117,139 +551,45 @@ class Analyse():
             return False
 
     def last_updated(self):
-        self._cur.execute("SELECT * FROM settings WHERE name = 'last_updated';")
-        data = self._cur.fetchone()
-        if data is not None:
-            date = datetime.fromtimestamp(float(data[1]))
-            return date
-        else:
-            return datetime.fromtimestamp(0)
+        return Settings.last_updated(self._cur)
 
-    def _get_average_prices(self, period: str="1mo") -> Dict:
-        self.timer.start("aggregate_average")
-        df = self._data.partition_by("type", as_dict=True)
-        house_types_means = {}
-        for house_type in df:
-            average_prices = self._calc_average_price(df[house_type],period)
-            house_types_means[house_type] = self.pad_df(average_prices, period).to_dict(as_series=False)
-
-        house_types_means["all"] = self.pad_df(self._calc_average_price(self._data, period), period).to_dict(as_series=False)
-        data = {
-            "type": [key for key in sorted(house_types_means)],
-            "prices": [house_types_means[key]["price"] for key in sorted(house_types_means)],
-            "dates": house_types_means["all"]["date"]
-        }
-        self.timer.end("aggregate_average")
-        del df
-        return data
-
-    def _calc_average_price(self, df: pl.DataFrame, period: str) -> pl.DataFrame:
-        df = df \
-            .sort("date") \
-            .groupby_dynamic("date", every=period) \
-            .agg(pl.col("price").log().mean().exp())
-        return df
-
-    def _get_type_proportions(self) -> Dict:
-        self.timer.start("aggregate_proportions")
-        df = self._data \
-            .unique(subset=["houseid"]) \
-            .groupby("type") \
-            .count() \
-            .sort("type")
-        data = df.to_dict(as_series=False)
-        self.timer.end("aggregate_proportions")
-        del df
-        return data
-
-    def _get_monthly_qtys(self, period: str="1mo") -> Dict:
-        self.timer.start("aggregate_qty")
-        df = self._data.partition_by("type", as_dict=True)
-        monthly_quantity = {}
-        for house_type in df:
-            volume = self._calc_monthly_qty(df[house_type],period)
-            monthly_quantity[house_type] = self.pad_df(volume, period).to_dict(as_series=False)
-
-        monthly_quantity["all"] = self.pad_df(self._calc_monthly_qty(self._data, period), period).to_dict(as_series=False)
-
-        data = {
-            "type": [key for key in sorted(monthly_quantity)],
-            "qty": [monthly_quantity[key]["qty"] for key in sorted(monthly_quantity)],
-            "dates": monthly_quantity["all"]["date"]
-        }
-        del df
-        self.timer.end("aggregate_qty")
-        return data
-
-    def _calc_monthly_qty(self, df: pl.DataFrame, period: str) -> pl.DataFrame:
-        volume = df \
-            .sort("date") \
-            .groupby_dynamic("date", every=period) \
-            .agg(pl.col("price").count().alias("qty"))
-        return volume
-
-    def _get_monthly_volumes(self, period: str = "1mo") -> Dict:
-        self.timer.start("aggregate_vol")
-        df = self._data.partition_by("type", as_dict=True)
-        monthly_volume = {}
-        for house_type in df:
-            volume = self._calc_monthly_vol(df[house_type],period)
-            monthly_volume[house_type] = self.pad_df(volume, period).to_dict(as_series=False)
-
-        monthly_volume["all"] = self.pad_df(self._calc_monthly_vol(self._data,period), period).to_dict(as_series=False)
-
-        data = {
-            "type": [key for key in sorted(monthly_volume)],
-            "volume": [monthly_volume[key]["volume"] for key in sorted(monthly_volume)],
-            "dates": monthly_volume["all"]["date"]
-        }
-        del df
-        self.timer.end("aggregate_vol")
-        return data
-
-    def _calc_monthly_vol(self, df: pl.DataFrame, period: str) -> pl.DataFrame:
-        volume = df \
-            .sort("date") \
-            .groupby_dynamic("date", every=period) \
-            .agg(pl.col("price").sum().alias("volume"))
-        return volume
-
-    def _get_percs(self, period: str = "1mo") -> Dict:
-        self.timer.start("aggregate_perc")
-        data = self._data.partition_by("type", as_dict=True)
-        monthly_perc = {}
-        for house_type in data:
-            monthly_perc[house_type] = self.pad_df(self._calc_ind_perc(data[house_type], period), period).to_dict(as_series=False)
-
-        monthly_perc["all"] = self.pad_df(self._calc_ind_perc(self._data, period), period).to_dict(as_series=False)
-
-        del data
-        self.timer.end("aggregate_perc")
-        return monthly_perc
-
-    def _calc_ind_perc(self, df: pl.DataFrame, period: str) -> pl.DataFrame:
-        df = df.sort("date") \
-            .groupby_dynamic("date", every=period) \
-            .agg(pl.col("price").log().mean().exp().alias("avg_price"))
-
-        df = df.with_columns([
-            pl.col("date").dt.round(period).alias("period"),
-        ])
-
-        df = self._calc_period_perc(df, period)
-        df = df \
-            .drop(["prev_period", "avg_price","period"]) \
-            .sort("date")
-        return df
-
-    def _calc_period_perc(self, df: pl.DataFrame, period) -> pl.DataFrame:
-        df = df \
-            .sort("date") \
+    def _add_overall(self, monthly: pl.DataFrame) -> pl.DataFrame:
+        overall = monthly \
+            .groupby("date") \
+            .agg([
+                pl.col("qty").sum(),
+                pl.col("volume").sum(),
+                pl.col("log_price").sum(),
+                pl.col("max_price").max(),
+            ]) \
+            .with_columns(pl.lit("all").alias("type")) \
+            .select(monthly.columns)
+        return pl.concat([monthly, overall]).sort("date")
+
+    def _aggregate_period(self, period: str = "1mo") -> pl.DataFrame:
+        self.timer.start(f"aggregate_{period}")
+        df = self._monthly_all.lazy() \
+            .groupby_dynamic("date", every=period, by="type") \
+            .agg([
+                pl.col("qty").sum(),
+                pl.col("volume").sum(),
+                pl.col("log_price").sum(),
+            ]) \
             .with_columns(
-                pl.col("avg_price").shift().alias("prev_period")
+                (pl.col("log_price") / pl.col("qty")).exp().alias("price")
             ) \
-            .filter(pl.col("prev_period").is_not_null())
-        
+            .select(["type", "date", "price", "qty", "volume"]) \
+            .sort(["type", "date"]) \
+            .with_columns(
+                pl.col("price").shift().over("type").alias("prev_period")
+            )
+        df = self._calc_period_perc(df, period) \
+            .drop("prev_period") \
+            .collect()
+        self.timer.end(f"aggregate_{period}")
+        return df
+
+    def _calc_period_perc(self, df: pl.LazyFrame, period: str) -> pl.LazyFrame:
         magic_numbers = {
             "1mo": 12,
             "3mo": 4,
@@ -258,48 +598,98 @@ class Analyse():
         } # It works and I dont know why
 
         df = df.with_columns(
-            (((pl.col("avg_price")-pl.col("prev_period"))
-                /pl.col("avg_price")
+            (((pl.col("price")-pl.col("prev_period"))
+                /pl.col("price")
                     *100)
                         /magic_numbers[period]).alias("perc_change")
         )
         return df
 
+    def _period_stats(self, period: str = "1mo") -> Dict:
+        df = self.pad_df(self._aggregate_period(period), period)
+        types = df.partition_by("type", as_dict=True)
+        house_types = sorted(types)
+        dates = types["all"].get_column("date").to_list()
+        data = {
+            "average_price": {
+                "type": house_types,
+                "prices": [types[key].get_column("price").to_list() for key in house_types],
+                "dates": dates
+            },
+            "monthly_qty": {
+                "type": house_types,
+                "qty": [types[key].get_column("qty").to_list() for key in house_types],
+                "dates": dates
+            },
+            "monthly_volume": {
+                "type": house_types,
+                "volume": [types[key].get_column("volume").to_list() for key in house_types],
+                "dates": dates
+            },
+            "percentage_change": {
+                key: types[key].select(["date", "perc_change"]).to_dict(as_series=False)
+                    for key in house_types
+            }
+        }
+        del df, types
+        return data
+
+    def _get_type_proportions(self) -> Dict:
+        self.timer.start("aggregate_proportions")
+        df = self._houses \
+            .filter(pl.col("houses") > 0) \
+            .select([pl.col("type"), pl.col("houses").alias("count")]) \
+            .sort("type")
+        data = df.to_dict(as_series=False)
+        self.timer.end("aggregate_proportions")
+        del df
+        return data
+
     def average_tenancy(self):
         self.timer.start("aggregate_tenancy")
-        data = self._data.partition_by("type", as_dict=True)
         tenancies = {}
-        for house_type in data:
-            df = self._get_ind_tenancy(data[house_type]) \
-                .to_dict(as_series=False)["date"][0]
-            if df is not None:
-                try:
-                    tenancies[house_type] = df.total_seconds()
-                except AttributeError:
-                    tenancies[house_type] = 0
-            else:
-                tenancies[house_type] = 0
-        try:
-            tenancies["all"] = self._get_ind_tenancy(self._data ) \
-                    .to_dict(as_series=False)["date"][0].total_seconds()
-        except AttributeError:
-            tenancies["all"] = 0
+        for house_type, holdings, tenancy in self._houses.select(["type", "holdings", "tenancy"]).rows():
+            tenancies[house_type] = self._calc_tenancy(holdings, tenancy)
+        tenancies["all"] = self._calc_tenancy(
+            self._houses.get_column("holdings").sum(),
+            self._houses.get_column("tenancy").sum()
+        )
         self.timer.end("aggregate_tenancy")
         return tenancies
 
-    def _get_ind_tenancy(self, df: pl.DataFrame) -> pl.DataFrame:
-        df = df\
-            .sort("date") \
-            .groupby("houseid", maintain_order=True) \
-            .agg([
-                (pl.col("date") - pl.col("date").shift()),
-            ]) \
-            .explode("date")
-
-        df = df \
-            .filter(pl.col("date").is_not_null()) \
-            .select(pl.col("date").mean())
-        return df
+    def _calc_tenancy(self, holdings: int, tenancy: int) -> float:
+        if not holdings:
+            return 0
+        return timedelta(microseconds=tenancy // holdings).total_seconds()
+
+    def tenancy_distribution(self) -> Dict:
+        """Histogram of holding periods in whole years, the last bin open ended,
+        with percentiles in years interpolated within the bins"""
+        self.timer.start("aggregate_tenancy_distribution")
+        df = self._houses.select(["type"] + HOLDING_COLUMNS).sort("type")
+        rows = df.rows() + [("all", *df.select(HOLDING_COLUMNS).sum().row(0))]
+        distribution = {}
+        for house_type, *histogram in rows:
+            distribution[house_type] = {
+                "histogram": histogram,
+                "percentiles": self._calc_percentiles(histogram)
+            }
+        self.timer.end("aggregate_tenancy_distribution")
+        return distribution
+
+    def _calc_percentiles(self, histogram: List[int]) -> Dict[str, float | None]:
+        total = sum(histogram)
+        percentiles = {}
+        for percentile in [25, 50, 75, 90]:
+            percentiles[str(percentile)] = None
+            target = total * percentile / 100
+            seen = 0
+            for year, count in enumerate(histogram):
+                if count > 0 and seen + count >= target:
+                    percentiles[str(percentile)] = round(year + (target - seen) / count, 2)
+                    break
+                seen += count
+        return percentiles
 
     def _quick_stats(self, data) -> Dict[str, float]:
 
@@ -326,12 +716,11 @@ class Analyse():
         except ZeroDivisionError:
             vol_change = None
 
-        try:
-            expensive_sale = (self._data
-                .filter(pl.col("date").is_between(current_month, current_month + timedelta(days=31)))
-                .filter(pl.col("price") == pl.col("price").max())
-                )[0,0]
-        except:
+        expensive_sale = self._monthly_all \
+            .filter((pl.col("type") == "all") & (pl.col("date") == current_month)) \
+            .get_column("max_price") \
+            .max()
+        if expensive_sale is None:
             expensive_sale = 0
 
         quick_stats = {
@@ -346,53 +735,73 @@ class Analyse():
         }
         return quick_stats
 
-    def get_all_data(self) -> Dict:
-        data_period = {}            
+    def _prepare_monthly(self) -> None:
+        if self._data is not None:
+            self.timer.start("aggregate_monthly")
+            self._data = self._data.sort("date")
+            self._monthly = monthly_stats(self._data)
+            self._houses = house_stats(self._data)
+            self.timer.end("aggregate_monthly")
+        self._monthly_all = self._add_overall(self._monthly)
+
+    def _house_stats(self) -> Dict:
         tenancy = self.average_tenancy()
+        distribution = self.tenancy_distribution()
         proportions = self._get_type_proportions()
-        for i in ["1mo","3mo","6mo","12mo"]:
-            average_prices = self._get_average_prices(period=i)
-            quantities =  self._get_monthly_qtys(period=i)
-            volume = self._get_monthly_volumes(period=i)
-            perc = self._get_percs(period=i)
-            data = {
-                "average_price": average_prices,
-                "type_proportions": proportions,
-                "monthly_qty": quantities,
-                "monthly_volume": volume,
-                "percentage_change": perc,
-                "average_tenancy": tenancy
-            }
+        return {
+            "type_proportions": proportions,
+            "average_tenancy": tenancy,
+            "tenancy_distribution": distribution
+        }
+
+    def get_all_data(self) -> Dict:
+        data_period = {}
+        self._prepare_monthly()
+        houses = self._house_stats()
+        for i in PERIODS:
+            data = self._period_stats(period=i)
+            data.update(houses)
 
             data["quick_stats"] = self._quick_stats(data)
             data_period[i] = data
 
         return data_period
 
+    def get_price_index(self, data: Dict) -> Dict:
+        """Cumulative monthly price index and monthly sales of each type
+
+        index[m + 1] / index[m] = 1 + perc_change[m] / 100, so a price paid in
+        month m is worth price * index[n] / index[m] in month n.
+        """
+        house_types = data["monthly_qty"]["type"]
+        index = {}
+        for house_type in house_types:
+            growth = 1 + pl.Series(data["percentage_change"][house_type]["perc_change"], dtype=pl.Float64) / 100
+            index[house_type] = [1.0] + growth.cumprod().to_list()
+        return {
+            "start": data["monthly_qty"]["dates"][0],
+            "index": index,
+            "qty": dict(zip(house_types, data["monthly_qty"]["qty"]))
+        }
+
     def pad_df(self, df: pl.DataFrame, period: str) -> pl.DataFrame | None:
         latest_date = self.latest_date
         if latest_date is not None:
             dates = pl.date_range(datetime(1995,1,1), latest_date, period, eager=True)
-            dates_df = pl.DataFrame(dates, schema=["date"])
+            dates_df = pl.DataFrame(dates, schema=["date"]) \
+                .filter(pl.col("date") < latest_date) \
+                .join(df.select("type").unique(), how="cross")
             try:
-                df = df.join(dates_df, on="date", how="outer")
+                df = dates_df.join(df, on=["date", "type"], how="left")
                 df = df.fill_null(0)
-                df = df.filter(pl.col("date") < latest_date)
+                df = df.sort(["type", "date"])
                 return df
             except pl_ex.ComputeError:
                 return df
 
     @property
     def latest_date(self) -> datetime | None:
-        self._cur.execute("SELECT data FROM settings WHERE name = 'last_updated';")
-        latest_date = self._cur.fetchone()
-        if latest_date is not None:
-            latest_date = datetime.fromtimestamp(float(latest_date[0]))
-            if latest_date > (datetime.now() - timedelta(days=60)):
-                start = datetime.now().replace(day=1).replace(hour=0,minute=0,second=0, microsecond=0)
-                return start - relativedelta(months=2)
-            else:
-                return latest_date
+        return Settings.latest_date(self._cur)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+from datetime import datetime
+from typing import Dict, List
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from pymongo import UpdateOne
+
+CACHE_VERSION = 2
+SERIES_TYPES = {
+    "average_price": ("prices", "<f4"),
+    "monthly_qty": ("qty", "<i4"),
+    "monthly_volume": ("volume", "<i8"),
+}
+PERC_TYPE = "<f4"
+INDEX_TYPES = {"index": "<f8", "qty": "<i4"}
+
+
+def pack(values: List, dtype: str) -> bytes:
+    return np.asarray(values, dtype=dtype).tobytes()
+
+
+def unpack(data: bytes | List, dtype: str) -> np.ndarray:
+    if isinstance(data, list):
+        return np.asarray(data, dtype=dtype)
+    return np.frombuffer(data, dtype=dtype)
+
+
+def series_dates(start: datetime | None, step: str, length: int) -> List[datetime]:
+    months = int(step[:-len("mo")])
+    return [start + relativedelta(months=i * months) for i in range(length)]
+
+
+def encode_stats(stats: Dict) -> Dict:
+    """Compact layout of the stats Analyse builds
+
+    Every series of a period shares one date grid, so it is stored once as
+    a start date, step and length, and the values of each type are packed
+    little endian arrays. Volumes are int64 as country totals overflow int32.
+    """
+    return {period: _encode_period(data, period) for period, data in stats.items()}
+
+
+def _encode_period(data: Dict, period: str) -> Dict:
+    encoded = dict(data)
+    dates = data["average_price"]["dates"]
+    encoded["dates"] = {
+        "start": dates[0] if len(dates) > 0 else None,
+        "step": period,
+        "length": len(dates)
+    }
+    for name, (key, dtype) in SERIES_TYPES.items():
+        encoded[name] = {
+            "type": data[name]["type"],
+            key: [pack(values, dtype) for values in data[name][key]]
+        }
+    percs = data["percentage_change"]
+    encoded["percentage_change"] = {
+        "type": list(percs),
+        "perc_change": [pack(percs[key]["perc_change"], PERC_TYPE) for key in percs]
+    }
+    return encoded
+
+
+def decode_stats(record: Dict) -> Dict:
+    """stats of a cache document in the layout Analyse builds, whatever its version"""
+    if record.get("version", 1) < 2:
+        return record["stats"]
+    return {period: _decode_period(data) for period, data in record["stats"].items()}
+
+
+def _decode_period(data: Dict) -> Dict:
+    decoded = dict(data)
+    dates = series_dates(**decoded.pop("dates"))
+    for name, (key, dtype) in SERIES_TYPES.items():
+        decoded[name] = {
+            "type": data[name]["type"],
+            key: [unpack(values, dtype).tolist() for values in data[name][key]],
+            "dates": dates
+        }
+    percs = data["percentage_change"]
+    decoded["percentage_change"] = {
+        key: {"date": dates, "perc_change": unpack(values, PERC_TYPE).tolist()}
+            for key, values in zip(percs["type"], percs["perc_change"])
+    }
+    return decoded
+
+
+def encode_price_index(price_index: Dict) -> Dict:
+    """Packs the price index of each type, kept as float64 so valuations are unchanged"""
+    encoded = dict(price_index)
+    for name, dtype in INDEX_TYPES.items():
+        if name in price_index:
+            encoded[name] = {key: pack(values, dtype) for key, values in price_index[name].items()}
+    return encoded
+
+
+def decode_price_index(price_index: Dict) -> Dict:
+    decoded = dict(price_index)
+    for name, dtype in INDEX_TYPES.items():
+        decoded[name] = {key: unpack(values, dtype) for key, values in price_index.get(name, {}).items()}
+    return decoded
+
+
+def migrate_cache(collection, chunk_size: int = 100) -> int:
+    """Rewrites cache documents older than CACHE_VERSION in the compact layout"""
+    writes = []
+    count = 0
+    for record in collection.find({"version": {"$exists": False}}):
+        update = {
+            "version": CACHE_VERSION,
+            "stats": encode_stats(record["stats"]),
+        }
+        if "price_index" in record:
+            update["price_index"] = encode_price_index(record["price_index"])
+        writes.append(UpdateOne({"_id": record["_id"], "version": {"$exists": False}}, {"$set": update}))
+        if len(writes) >= chunk_size:
+            count += collection.bulk_write(writes, ordered=False).modified_count
+            writes = []
+    if len(writes) > 0:
+        count += collection.bulk_write(writes, ordered=False).modified_count
+    return count
@@ -31,3 +31,22 @@ class Config:
     MONGO_PASSWORD = manage_sensitive("MONGO_PASSWORD")
     CELERY_BROKER_URL = manage_sensitive("CELERY_BROKER_URL")
     CELERY_RESULT_BACKEND = manage_sensitive("CELERY_RESULT_BACKEND")
+    SQL_POOL_SIZE = int(manage_sensitive("SQL_POOL_SIZE", default="4"))
+    LOADER_PARTITIONS = int(manage_sensitive("LOADER_PARTITIONS", default="4"))
+    SNAPSHOT_DIR = manage_sensitive("SNAPSHOT_DIR", default="")
+    VALUATION_CACHE_MB = int(manage_sensitive("VALUATION_CACHE_MB", default="64"))
+    VALUATION_CACHE_TTL = int(manage_sensitive("VALUATION_CACHE_TTL", default="600"))
+    STREAM_MEMORY_MB = int(manage_sensitive("STREAM_MEMORY_MB", default="512"))
+    PUSHDOWN_AREA_TYPES = manage_sensitive("PUSHDOWN_AREA_TYPES", default="area,county,district").split(",")
+    METRICS_PORT = int(manage_sensitive("METRICS_PORT", default="0"))
+    LOCK_REDIS_URL = manage_sensitive("LOCK_REDIS_URL", default=CELERY_RESULT_BACKEND)
+    SINGLE_FLIGHT_LEASE = int(manage_sensitive("SINGLE_FLIGHT_LEASE", default="60"))
+    SINGLE_FLIGHT_TIMEOUT = int(manage_sensitive("SINGLE_FLIGHT_TIMEOUT", default="1800"))
+    SALES_PER_POSTCODE = float(manage_sensitive("SALES_PER_POSTCODE", default="16"))
+    INTERACTIVE_MAX_SALES = int(manage_sensitive("INTERACTIVE_MAX_SALES", default="50000"))
+    HEAVY_MIN_SALES = int(manage_sensitive("HEAVY_MIN_SALES", default="1000000"))
+    WORKER_MAX_MEMORY_MB = int(manage_sensitive("WORKER_MAX_MEMORY_MB", default="0"))
+    PROGRESSIVE_PUBLISH = manage_sensitive("PROGRESSIVE_PUBLISH", default="true").lower() == "true"
+    POSTCODE_INDEX = manage_sensitive("POSTCODE_INDEX", default="true").lower() == "true"
+    PIPELINE_DEPTH = int(manage_sensitive("PIPELINE_DEPTH", default="2"))
+    PIPELINE_WRITES = int(manage_sensitive("PIPELINE_WRITES", default="8"))
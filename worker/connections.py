@@ -0,0 +1,99 @@
+import os
+from typing import List
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from pymongo import MongoClient
+from redis import Redis
+from worker.config import Config
+
+
+class Connections():
+    """Postgres pool, Mongo client and Redis client shared by every task of a worker process
+
+    They are opened once per prefork child and reopened if the process has
+    forked since. Postgres connections are checked on the way out of the
+    pool and reset or discarded on the way back, and any a task leaves
+    checked out are returned when it finishes.
+    """
+    _pid: int | None = None
+    _sql_pool: ThreadedConnectionPool | None = None
+    _mongo: MongoClient | None = None
+    _redis: Redis | None = None
+    _checked_out: List = []
+
+    @classmethod
+    def open(cls) -> None:
+        config = Config()
+        cls._sql_pool = ThreadedConnectionPool(1, config.SQL_POOL_SIZE, cls.sql_uri())
+        cls._mongo = MongoClient(f"mongodb://{config.MONGO_USER}:{config.MONGO_PASSWORD}@{config.MONGO_HOST}:27017/?authSource=house_data")
+        cls._redis = Redis.from_url(config.LOCK_REDIS_URL) if config.LOCK_REDIS_URL.startswith(("redis://", "rediss://")) else None
+        cls._checked_out = []
+        cls._pid = os.getpid()
+
+    @classmethod
+    def close(cls) -> None:
+        if cls._pid == os.getpid():
+            cls._sql_pool.closeall()
+            cls._mongo.close()
+            if cls._redis is not None:
+                cls._redis.close()
+        cls._sql_pool = None
+        cls._mongo = None
+        cls._redis = None
+        cls._pid = None
+
+    @classmethod
+    def _check_open(cls) -> None:
+        if cls._pid != os.getpid():
+            cls.open()
+
+    @staticmethod
+    def sql_uri() -> str:
+        config = Config()
+        return f"postgresql://{config.SQL_USER}:{config.SQL_PASSWORD}@{config.SQL_HOST}:5432/house_data"
+
+    @classmethod
+    def get_sql(cls):
+        cls._check_open()
+        for _ in range(3):
+            conn = cls._sql_pool.getconn()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1;")
+                conn.rollback()
+            except psycopg2.Error:
+                cls._sql_pool.putconn(conn, close=True)
+                continue
+            cls._checked_out.append(conn)
+            return conn
+        raise psycopg2.OperationalError("Unable to get a healthy Postgres connection")
+
+    @classmethod
+    def put_sql(cls, conn) -> None:
+        if conn in cls._checked_out:
+            cls._checked_out.remove(conn)
+        if cls._sql_pool is None or cls._pid != os.getpid():
+            conn.close()
+            return
+        try:
+            conn.rollback()
+            cls._sql_pool.putconn(conn)
+        except psycopg2.Error:
+            cls._sql_pool.putconn(conn, close=True)
+
+    @classmethod
+    def release_all(cls) -> None:
+        for conn in list(cls._checked_out):
+            cls.put_sql(conn)
+
+    @classmethod
+    def mongo(cls) -> MongoClient:
+        cls._check_open()
+        return cls._mongo
+
+    @classmethod
+    def redis(cls) -> Redis | None:
+        """Client of the Redis the single flight leases live in, None if it isn't Redis"""
+        cls._check_open()
+        return cls._redis
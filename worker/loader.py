@@ -1,19 +1,32 @@
-from datetime import datetime, timedelta
-from typing import List, Tuple
+from datetime import datetime
+from typing import Iterator, List, Tuple
 from polars import exceptions as pl_ex
 
 import polars as pl
-from dateutil.relativedelta import relativedelta
+from worker.aggregation import (CELL_COLUMNS, COLUMN_TYPES, HOUSE_COLUMNS,
+                                MONTHLY_COLUMNS, TENANCY_BINS, YEAR_US)
+from worker.postcode_index import PostcodeIndex
+from worker.settings import Settings
+from worker.snapshot import Snapshot
 
 
 class Loader():
-    def __init__(self, area: str, area_type: str, db_cur, sql_uri: str) -> None:
+    large_areas = ["", "area", "county", "district"]
+    by: List[str] = []
+
+    def __init__(self, area: str, area_type: str, db_cur, sql_uri: str, partitions: int = 1,
+                 snapshot: Snapshot | None = None) -> None:
         self._sql_uri = sql_uri
         self._cur = db_cur
         self.area_type = area_type.lower()
         self.area = area.upper()
+        self.partitions = partitions if self.area_type in self.large_areas else 1
+        self.snapshot = snapshot
         if self.validate_areas():
-            self.fetch_area_sales()
+            if self.snapshot is not None:
+                self.scan_snapshot()
+            else:
+                self.fetch_area_sales()
             self.format_df()
 
     def validate_areas(self) -> bool | None:
@@ -27,53 +40,353 @@ class Loader():
                 return True
 
     def verify_area(self):
-        self._cur.execute(f"SELECT postcode FROM postcodes WHERE {self.area_type} = %s LIMIT 1;", (self.area,))
-        if self._cur.fetchall() is not []:
+        index = PostcodeIndex.get(self._cur) if self.area_type in PostcodeIndex.area_types else None
+        if index is not None:
+            found = index.contains(self.area, self.area_type)
+        else:
+            self._cur.execute(f"SELECT postcode FROM postcodes WHERE {self.area_type} = %s LIMIT 1;", (self.area,))
+            found = self._cur.fetchone() is not None
+        if found:
             return True
         else:
             raise ValueError(f"Invalid {self.area_type} entered")
 
     def fetch_area_sales(self):
-        query = f"""SELECT s.price, s.date, h.type, h.paon, h.saon, h.postcode, p.street, p.town, h.houseid
+        latest_date = self.latest_date
+        queries = []
+        for start, end in self._date_ranges(latest_date):
+            query = f"""SELECT s.price, s.date, h.type, h.houseid
+                    FROM postcodes AS p
+                    INNER JOIN houses AS h ON p.postcode = h.postcode AND p.{self.area_type} = '{self.area}'
+                    INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
+                    WHERE s.ppd_cat = 'A' AND s.date >= '{start}' AND s.date < '{end}'
+                    ORDER BY s.date
+                    """
+            if self.area == "" and self.area_type == "":
+                query = query.replace("AND p. = ''", "")
+            queries.append(query)
+        self._data = pl.read_database(queries if len(queries) > 1 else queries[0], self._sql_uri)
+        if len(self._data) == 0:
+            raise RuntimeError("No Sales for this area")
+
+    def scan_snapshot(self):
+        self._data = self.snapshot.scan(self.area, self.area_type, self.latest_date)
+        if len(self._data) == 0:
+            raise RuntimeError("No Sales for this area")
+
+    def _date_ranges(self, latest_date: datetime) -> List[Tuple[datetime, datetime]]:
+        """Splits the sales history into one date range per connection"""
+        start = datetime(1900, 1, 1)
+        if self.partitions <= 1:
+            return [(start, latest_date)]
+        years = latest_date.year - 1995
+        bounds = [datetime(1995 + (years * i) // self.partitions, 1, 1) for i in range(1, self.partitions)]
+        bounds = [bound for bound in bounds if start < bound < latest_date]
+        return list(zip([start] + bounds, bounds + [latest_date]))
+
+    def format_df(self):
+        self._data = self._data.with_columns([
+            pl.col("price").cast(pl.Int64),
+            pl.col("date").cast(pl.Datetime("us")),
+            pl.col("type").cast(pl.Categorical),
+        ])
+        if self._data.get_column("date").is_sorted():
+            self._data = self._data.with_columns(pl.col("date").set_sorted())
+        else:
+            self._data = self._data.sort("date")
+
+    @property
+    def latest_date(self) -> datetime | None:
+        return Settings.latest_date(self._cur)
+
+    @property
+    def _area_filter(self) -> Tuple[str, Tuple]:
+        if self.area == "" and self.area_type == "":
+            return "", ()
+        return f"AND p.{self.area_type} = %s", (self.area,)
+
+    def house_totals(self) -> pl.DataFrame:
+        area_filter, params = self._area_filter
+        keys = ", ".join(self.by + ["type"])
+        bins = ", ".join(
+            f"COUNT(*) FILTER (WHERE LEAST(FLOOR(held / {YEAR_US}), {TENANCY_BINS - 1}) = {year})"
+                for year in range(TENANCY_BINS)
+        )
+        self._cur.execute(f"""SELECT {keys}, COUNT(*) - COUNT(held), COUNT(held), COALESCE(SUM(held), 0)::bigint, {bins}
+                FROM (
+                    SELECT {"".join(f"p.{column}, " for column in self.by)}h.type,
+                        EXTRACT(EPOCH FROM s.date::timestamp - LAG(s.date::timestamp) OVER (PARTITION BY h.houseid ORDER BY s.date)) * 1000000 AS held
+                    FROM postcodes AS p
+                    INNER JOIN houses AS h ON p.postcode = h.postcode {area_filter}
+                    INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
+                    WHERE s.ppd_cat = 'A' AND s.date < %s
+                ) AS holdings
+                GROUP BY {keys}
+                ORDER BY {keys};""", params + (self.latest_date,))
+        return pl.DataFrame(self._cur.fetchall(), schema={
+            column: COLUMN_TYPES.get(column, pl.Utf8) for column in self.by + HOUSE_COLUMNS
+        }, orient="row")
+
+
+    def get_data(self) -> pl.DataFrame:
+        return self._data
+
+
+class SectorLoader(Loader):
+    """Loads the sales of a list of sectors with their postcode hierarchy"""
+    def __init__(self, sectors: List[str], db_cur, sql_uri: str) -> None:
+        self._sql_uri = sql_uri
+        self._cur = db_cur
+        self.sectors = sectors
+        self.fetch_area_sales()
+        self.format_df()
+
+    def fetch_area_sales(self):
+        sectors = ", ".join("'" + sector.replace("'", "''") + "'" for sector in self.sectors)
+        query = f"""SELECT s.price, s.date, h.type, h.houseid, {", ".join(f"p.{column}" for column in CELL_COLUMNS)}
+                FROM postcodes AS p
+                INNER JOIN houses AS h ON p.postcode = h.postcode AND p.sector IN ({sectors})
+                INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
+                WHERE s.ppd_cat = 'A' AND s.date < '{self.latest_date}'
+                ORDER BY s.date
+                """
+        self._data = pl.read_database(query, self._sql_uri)
+
+
+class BatchLoader(Loader):
+    """Loads the sales of one postcode area labelled with the area_type they are in
+
+    Every area of a type is a union of these labelled chunks, so a whole area
+    type can be aggregated one postcode area at a time.
+    """
+    def __init__(self, area_type: str, chunk: str, db_cur, sql_uri: str,
+                 snapshot: Snapshot | None = None) -> None:
+        self._sql_uri = sql_uri
+        self._cur = db_cur
+        self.area_type = area_type.lower()
+        self.chunk = chunk
+        self.snapshot = snapshot
+        if self.area_type not in ["postcode", "street", "town", "district", "county", "outcode", "area", "sector"]:
+            raise ValueError("Invalid area type")
+        if self.snapshot is not None:
+            self._data = self.snapshot.scan(self.chunk, "area", self.latest_date,
+                                            columns=["price", "date", "type", "houseid", self.area_type])
+        else:
+            self.fetch_area_sales()
+        if len(self._data) > 0:
+            self.format_df()
+
+    def fetch_area_sales(self):
+        query = f"""SELECT s.price, s.date, h.type, h.houseid, p.{self.area_type}
+                FROM postcodes AS p
+                INNER JOIN houses AS h ON p.postcode = h.postcode AND p.area = '{self.chunk}'
+                INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
+                WHERE s.ppd_cat = 'A' AND s.date < '{self.latest_date}'
+                ORDER BY s.date
+                """
+        self._data = pl.read_database(query, self._sql_uri)
+
+
+class IncrementLoader(Loader):
+    """Loads what changed in an area since a cached cut-off
+
+    The sales on or after the cut-off are returned together with the date of
+    each house's last sale before it, so cached holding periods can be
+    extended without reloading the history.
+    """
+    def __init__(self, area: str, area_type: str, db_cur, sql_uri: str, cutoff: datetime) -> None:
+        self._sql_uri = sql_uri
+        self._cur = db_cur
+        self.area_type = area_type.lower()
+        self.area = area.upper()
+        self.cutoff = cutoff
+        self.validate_areas()
+
+    def monthly_totals(self) -> pl.DataFrame:
+        area_filter, params = self._area_filter
+        self._cur.execute(f"""SELECT h.type, date_trunc('month', s.date::timestamp) AS date, COUNT(*), SUM(s.price)::bigint
+                FROM postcodes AS p
+                INNER JOIN houses AS h ON p.postcode = h.postcode {area_filter}
+                INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
+                WHERE s.ppd_cat = 'A' AND s.date < %s
+                GROUP BY 1, 2;""", params + (self.cutoff,))
+        return pl.DataFrame(self._cur.fetchall(), schema={
+            "type": pl.Utf8,
+            "date": pl.Datetime("us"),
+            "qty": pl.Int64,
+            "volume": pl.Int64
+        }, orient="row")
+
+    def fetch_area_sales(self, months: List[datetime] | None = None):
+        query = f"""SELECT s.price, s.date, h.type, h.houseid,
+                    (SELECT MAX(ps.date) FROM sales AS ps
+                        WHERE ps.houseid = h.houseid AND ps.ppd_cat = 'A' AND ps.date < '{self.cutoff}') AS prev_date
                 FROM postcodes AS p
                 INNER JOIN houses AS h ON p.postcode = h.postcode AND p.{self.area_type} = '{self.area}'
                 INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
                 WHERE s.ppd_cat = 'A' AND s.date < '{self.latest_date}'
+                    AND (s.date >= '{self.cutoff}'{self._month_filter(months or [])})
+                ORDER BY s.date
                 """
         if self.area == "" and self.area_type == "":
             query = query.replace("AND p. = ''", "")
         self._data = pl.read_database(query, self._sql_uri)
-        if len(self._data) == 0:
-            raise RuntimeError("No Sales for this area")
+        if len(self._data) > 0:
+            self.format_df()
+            self._data = self._data.with_columns(pl.col("prev_date").cast(pl.Datetime("us")))
+        else:
+            self._data = pl.DataFrame(schema={
+                "price": pl.Int64,
+                "type": pl.Categorical,
+                "houseid": pl.Utf8,
+                "prev_date": pl.Datetime("us"),
+                "date": pl.Datetime("us")
+            })
 
+    def _month_filter(self, months: List[datetime]) -> str:
+        if len(months) == 0:
+            return ""
+        months = ", ".join(f"'{month}'" for month in months)
+        return f" OR date_trunc('month', s.date::timestamp) IN ({months})"
 
-    def format_df(self):
-        self._data = self._data.with_columns([
-            pl.col('date').apply(lambda x: datetime(*x.timetuple()[:-4])).alias("dt") # type: ignore
-        ])
-        self._data = self._data \
-            .drop("date") \
-            .rename({"dt":"date"})
-        self._data = self._data.with_columns([
-            pl.col("price").cast(pl.Int64).alias("price")
-        ])
+
+class SectorIncrementLoader(IncrementLoader):
+    """Loads what changed in a list of sectors since a cached cut-off, with
+    their postcode hierarchy, for the per sector states of Rollup"""
+    by = CELL_COLUMNS
+
+    def __init__(self, sectors: List[str], db_cur, sql_uri: str, cutoff: datetime) -> None:
+        self._sql_uri = sql_uri
+        self._cur = db_cur
+        self.sectors = sectors
+        self.cutoff = cutoff
 
     @property
-    def latest_date(self) -> datetime | None:
-        self._cur.execute("SELECT data FROM settings WHERE name = 'last_updated';")
-        latest_date = self._cur.fetchone()[0]
-        if latest_date is not None:
-            latest_date = datetime.fromtimestamp(float(latest_date))
-            if latest_date > (datetime.now() - timedelta(days=60)):
-                start = datetime.now().replace(day=1).replace(hour=0,minute=0,second=0, microsecond=0)
-                return start - relativedelta(months=2)
-            else:
-                return latest_date
+    def _area_filter(self) -> Tuple[str, Tuple]:
+        return "AND p.sector = ANY(%s)", (self.sectors,)
 
+    def monthly_totals(self) -> pl.DataFrame:
+        self._cur.execute("""SELECT p.sector, h.type, date_trunc('month', s.date::timestamp) AS date, COUNT(*), SUM(s.price)::bigint
+                FROM postcodes AS p
+                INNER JOIN houses AS h ON p.postcode = h.postcode AND p.sector = ANY(%s)
+                INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
+                WHERE s.ppd_cat = 'A' AND s.date < %s
+                GROUP BY 1, 2, 3;""", (self.sectors, self.cutoff))
+        return pl.DataFrame(self._cur.fetchall(), schema={
+            "sector": pl.Utf8,
+            "type": pl.Utf8,
+            "date": pl.Datetime("us"),
+            "qty": pl.Int64,
+            "volume": pl.Int64
+        }, orient="row")
 
-    def get_data(self) -> pl.DataFrame:
+    def fetch_area_sales(self, months: List[datetime] | None = None):
+        sectors = ", ".join("'" + sector.replace("'", "''") + "'" for sector in self.sectors)
+        query = f"""SELECT s.price, s.date, h.type, h.houseid, {", ".join(f"p.{column}" for column in CELL_COLUMNS)},
+                    (SELECT MAX(ps.date) FROM sales AS ps
+                        WHERE ps.houseid = h.houseid AND ps.ppd_cat = 'A' AND ps.date < '{self.cutoff}') AS prev_date
+                FROM postcodes AS p
+                INNER JOIN houses AS h ON p.postcode = h.postcode AND p.sector IN ({sectors})
+                INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
+                WHERE s.ppd_cat = 'A' AND s.date < '{self.latest_date}'
+                    AND (s.date >= '{self.cutoff}'{self._month_filter(months or [])})
+                ORDER BY s.date
+                """
+        self._data = pl.read_database(query, self._sql_uri)
+        if len(self._data) > 0:
+            self.format_df()
+            self._data = self._data.with_columns(pl.col("prev_date").cast(pl.Datetime("us")))
+        else:
+            self._data = pl.DataFrame(schema={
+                "price": pl.Int64,
+                "date": pl.Datetime("us"),
+                "type": pl.Categorical,
+                "houseid": pl.Utf8,
+                **{column: pl.Utf8 for column in CELL_COLUMNS},
+                "prev_date": pl.Datetime("us")
+            })
+
+
+class StreamLoader(Loader):
+    """Streams the sales of an area in houseid order through a server-side cursor
+
+    Every chunk holds whole houses, so monthly and house totals worked out
+    per chunk merge exactly into the area's, while no more than about
+    memory_mb of sales is held at once.
+    """
+    row_bytes = 256
+
+    def __init__(self, area: str, area_type: str, db_conn, db_cur, memory_mb: int) -> None:
+        self._conn = db_conn
+        self._cur = db_cur
+        self.area_type = area_type.lower()
+        self.area = area.upper()
+        self.chunk_rows = max(1, memory_mb * 1024 * 1024 // self.row_bytes)
+        self.validate_areas()
+
+    def chunks(self) -> Iterator[pl.DataFrame]:
+        query = f"""SELECT s.price, s.date, h.type, h.houseid
+                FROM postcodes AS p
+                INNER JOIN houses AS h ON p.postcode = h.postcode AND p.{self.area_type} = %s
+                INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
+                WHERE s.ppd_cat = 'A' AND s.date < %s
+                ORDER BY h.houseid
+                """
+        params = (self.area, self.latest_date)
+        if self.area == "" and self.area_type == "":
+            query = query.replace("AND p. = %s", "")
+            params = (self.latest_date,)
+        with self._conn.cursor(name="stream_sales") as cur:
+            cur.itersize = self.chunk_rows
+            cur.execute(query, params)
+            carry = []
+            while True:
+                rows = cur.fetchmany(self.chunk_rows)
+                if len(rows) == 0:
+                    break
+                rows = carry + rows
+                split = len(rows)
+                while split > 0 and rows[split - 1][3] == rows[-1][3]:
+                    split -= 1
+                carry = rows[split:]
+                if split > 0:
+                    yield self._frame(rows[:split])
+            if len(carry) > 0:
+                yield self._frame(carry)
+
+    def _frame(self, rows: List[Tuple]) -> pl.DataFrame:
+        self._data = pl.DataFrame(rows, schema=["price", "date", "type", "houseid"], orient="row")
+        self.format_df()
         return self._data
 
+
+class AggregateLoader(Loader):
+    """Pushes the monthly and house aggregation of an area down to Postgres
+
+    Only a row per type and month, and one per type for the house totals,
+    cross the wire instead of every sale in the area.
+    """
+    def __init__(self, area: str, area_type: str, db_cur) -> None:
+        self._cur = db_cur
+        self.area_type = area_type.lower()
+        self.area = area.upper()
+        self.validate_areas()
+
+    def monthly_stats(self) -> pl.DataFrame:
+        area_filter, params = self._area_filter
+        self._cur.execute(f"""SELECT h.type, date_trunc('month', s.date::timestamp) AS date, COUNT(*),
+                    SUM(s.price)::bigint, SUM(LN(s.price::float8)), MAX(s.price)
+                FROM postcodes AS p
+                INNER JOIN houses AS h ON p.postcode = h.postcode {area_filter}
+                INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
+                WHERE s.ppd_cat = 'A' AND s.date < %s
+                GROUP BY 1, 2
+                ORDER BY 2, 1;""", params + (self.latest_date,))
+        return pl.DataFrame(self._cur.fetchall(), schema={
+            column: COLUMN_TYPES.get(column, pl.Utf8) for column in MONTHLY_COLUMNS
+        }, orient="row")
+
+
 if __name__ == "__main__":
     import psycopg2
     from config import Config
@@ -0,0 +1,82 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def prefetch(items: Iterable[T], fetch: Callable[[T], R], depth: int,
+             discard: Callable[[R], None] | None = None) -> Iterator[Tuple[T, R]]:
+    """Yields each item with fetch(item), in order, fetching up to depth items
+    ahead on threads while the caller works on the current one
+
+    connectorx, psycopg2 and polars release the GIL while they work, so the
+    fetches overlap with the caller's aggregation. If the caller stops early,
+    the results fetched ahead and never yielded are passed to discard, so
+    whatever they hold can be let go of.
+    """
+    pool = ThreadPoolExecutor(max_workers=max(1, depth))
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, pool.submit(fetch, item)))
+            if len(pending) > depth:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while len(pending) > 0:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        if discard is not None:
+            for item, future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    discard(future.result())
+
+
+class BackgroundWriter():
+    """Runs writes in the order they are submitted on a background thread
+
+    At most max_pending writes wait in the queue, after which submit blocks,
+    so a slow database holds the producer back instead of piling up
+    documents in memory. A write that fails doesn't stop the ones after it;
+    the first error is raised from close.
+    """
+    def __init__(self, max_pending: int) -> None:
+        self._queue = queue.Queue(max(1, max_pending))
+        self._error: Exception | None = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, write: Callable, *args, **kwargs) -> None:
+        self._queue.put((write, args, kwargs))
+
+    def flushed(self) -> threading.Event:
+        """Event set once every write submitted so far has run"""
+        event = threading.Event()
+        self._queue.put((event.set, (), {}))
+        return event
+
+    def close(self) -> None:
+        """Waits for every submitted write to finish"""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            write, args, kwargs = job
+            try:
+                write(*args, **kwargs)
+            except Exception as e:
+                print(e)
+                if self._error is None:
+                    self._error = e
@@ -0,0 +1,111 @@
+from datetime import datetime
+from typing import Dict, List
+
+import numpy as np
+import polars as pl
+from worker.config import Config
+from worker.connections import Connections
+from worker.settings import Settings
+
+LEVELS = ["sector", "outcode", "area", "district", "county", "town"]
+
+
+class PostcodeIndex():
+    """Per process index of which sector, outcode, area, district, county and
+    town every postcode is in
+
+    Postcodes are kept as a sorted array of bytes and each level as int16
+    or int32 codes into its sorted distinct values, -1 where the postcode
+    has none, so the whole table takes tens of megabytes. It is loaded on first use
+    and again whenever last_updated moves on. Streets are not indexed.
+    """
+    enabled = Config.POSTCODE_INDEX
+    area_types = ["postcode"] + LEVELS
+    _index: "PostcodeIndex | None" = None
+    _last_updated: datetime | None = None
+
+    def __init__(self, df: pl.DataFrame) -> None:
+        df = df.filter(pl.col("postcode").is_not_null()).sort("postcode")
+        self._postcodes = df.get_column("postcode").to_numpy().astype(bytes)
+        self._values: Dict[str, List[str]] = {}
+        self._lookup: Dict[str, Dict[str, int]] = {}
+        self._codes: Dict[str, np.ndarray] = {}
+        for level in LEVELS:
+            values = df.get_column(level).drop_nulls().unique().sort()
+            codes = df.select(level) \
+                .join(values.to_frame().with_row_count("code"), on=level, how="left") \
+                .get_column("code") \
+                .cast(pl.Int16 if len(values) < 2 ** 15 else pl.Int32) \
+                .fill_null(-1)
+            self._values[level] = values.to_list()
+            self._lookup[level] = {value: code for code, value in enumerate(self._values[level])}
+            self._codes[level] = codes.to_numpy()
+
+    @classmethod
+    def get(cls, db_cur) -> "PostcodeIndex | None":
+        """The index as of the latest data, None if it is disabled"""
+        if not cls.enabled:
+            return None
+        last_updated = Settings.last_updated(db_cur)
+        if cls._index is None or cls._last_updated != last_updated:
+            cls._index = cls.load()
+            cls._last_updated = last_updated
+        return cls._index
+
+    @classmethod
+    def load(cls) -> "PostcodeIndex":
+        query = f"SELECT postcode, {', '.join(LEVELS)} FROM postcodes;"
+        return cls(pl.read_database(query, Connections.sql_uri()))
+
+    def contains(self, area: str, area_type: str) -> bool:
+        if area_type == "postcode":
+            return self._find(area) is not None
+        return area in self._lookup[area_type]
+
+    def areas(self, area_type: str) -> List[str]:
+        return list(self._values[area_type])
+
+    def children(self, area: str, area_type: str, child_type: str) -> List[str]:
+        """Distinct child_type areas with postcodes in area, or in the country when area_type is empty"""
+        if area_type == "postcode":
+            resolved = self.resolve(area)
+            if resolved is None or resolved[child_type] is None:
+                return []
+            return [resolved[child_type]]
+        codes = self._codes[child_type]
+        if area_type != "":
+            code = self._lookup[area_type].get(area)
+            if code is None:
+                return []
+            codes = codes[self._codes[area_type] == code]
+        values = self._values[child_type]
+        return [values[code] for code in np.unique(codes) if code >= 0]
+
+    def resolve(self, postcode: str) -> Dict[str, str | None] | None:
+        """Areas a postcode is in, None if it isn't a known postcode"""
+        row = self._find(postcode)
+        if row is None:
+            return None
+        resolved = {}
+        for level in LEVELS:
+            code = self._codes[level][row]
+            resolved[level] = self._values[level][code] if code >= 0 else None
+        return resolved
+
+    def _find(self, postcode: str | None) -> int | None:
+        if postcode is None:
+            return None
+        key = postcode.encode()
+        row = int(np.searchsorted(self._postcodes, key))
+        if row < len(self._postcodes) and self._postcodes[row] == key:
+            return row
+        return None
+
+
+def postcode_areas(db_cur) -> List[str]:
+    """Every postcode area, the first part of an outcode such as EX"""
+    index = PostcodeIndex.get(db_cur)
+    if index is not None:
+        return index.areas("area")
+    db_cur.execute("SELECT DISTINCT area FROM postcodes WHERE area IS NOT NULL;")
+    return [row[0] for row in db_cur.fetchall()]
@@ -0,0 +1,178 @@
+import os
+import resource
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+import polars as pl
+from prometheus_client import (CollectorRegistry, Histogram, multiprocess,
+                               start_http_server)
+
+LABELS = ["task", "area_type", "cache", "stage"]
+STAGE_SECONDS = Histogram(
+    "worker_stage_seconds", "Wall time of each stage of a task", LABELS,
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+STAGE_ROWS = Histogram(
+    "worker_stage_rows", "Rows loaded by each stage of a task", LABELS,
+    buckets=(1, 10, 100, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+)
+STAGE_BYTES = Histogram(
+    "worker_stage_bytes", "Bytes loaded by each stage of a task", LABELS,
+    buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10)
+)
+STAGE_RSS = Histogram(
+    "worker_stage_rss_bytes", "Resident memory of the worker process at the end of each stage", LABELS,
+    buckets=(64e6, 128e6, 256e6, 512e6, 1e9, 2e9, 4e9, 8e9, 16e9, 32e9)
+)
+STAGE_RSS_GROWTH = Histogram(
+    "worker_stage_rss_growth_bytes", "Resident memory each stage added between its start and end", LABELS,
+    buckets=(1e6, 1e7, 64e6, 128e6, 256e6, 512e6, 1e9, 2e9, 4e9, 8e9, 16e9)
+)
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_rss() -> int:
+    """High water mark of the process's resident memory over its whole life"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss() -> int:
+    """Resident memory of the process now, or its high water mark without /proc"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return peak_rss()
+
+
+def start_metrics_server(port: int) -> None:
+    """Serves the metrics of every worker process, which write them to
+    PROMETHEUS_MULTIPROC_DIR when it is set"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, registry=registry)
+    else:
+        start_http_server(port)
+
+
+def mark_process_dead(pid: int) -> None:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+
+class Span():
+    def __init__(self, name: str, path: str) -> None:
+        self.name = name
+        self.path = path
+        self.time = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.start_rss = current_rss()
+        self.rss = 0
+        self.children: List[Span] = []
+        self._start = time.perf_counter()
+
+    def finish(self) -> None:
+        self.time = time.perf_counter() - self._start
+        self.rss = current_rss()
+
+    @property
+    def rss_growth(self) -> int:
+        return self.rss - self.start_rss
+
+
+def merge_spans(spans: List[Span]) -> Dict[str, Dict]:
+    """Spans by name, adding up the ones a loop repeats"""
+    groups: Dict[str, List[Span]] = {}
+    for span in spans:
+        groups.setdefault(span.name, []).append(span)
+    merged = {}
+    for name, group in groups.items():
+        merged[name] = {
+            "time": sum(span.time for span in group),
+            "count": len(group),
+            "rows": sum(span.rows for span in group),
+            "bytes": sum(span.bytes for span in group),
+            "rss": max(span.rss for span in group),
+            "rss_growth": max(span.rss_growth for span in group),
+        }
+        children = [child for span in group for child in span.children]
+        if len(children) > 0:
+            merged[name]["spans"] = merge_spans(children)
+    return merged
+
+
+class Profiler():
+    """Nested timing spans of one task, with the rows, bytes and peak memory of each
+
+    Spans are timed with perf_counter and kept in a tree, so repeated and
+    nested stages are all recorded. Each finished span is also observed by
+    the worker's Prometheus histograms, labelled by task, area_type, cache
+    hit or miss and its path. The resident memory of the process is read at
+    the start and end of each span, so a span's growth is its own even in a
+    long lived worker whose high water mark was set by an earlier task.
+    """
+    def __init__(self, task: str, area_type: str = "") -> None:
+        self.labels = {"task": task, "area_type": area_type, "cache": "miss"}
+        self._root = Span("", "")
+        self._stack = [self._root]
+
+    def set_cache(self, hit: bool) -> None:
+        self.labels["cache"] = "hit" if hit else "miss"
+
+    def start(self, function: str) -> None:
+        parent = self._stack[-1]
+        span = Span(function, f"{parent.path}/{function}" if parent.path else function)
+        parent.children.append(span)
+        self._stack.append(span)
+
+    def end(self, function: str) -> None:
+        if len(self._stack) == 1 or self._stack[-1].name != function:
+            raise ValueError("Invalid function provided")
+        span = self._stack.pop()
+        span.finish()
+        self._observe(span.path, span)
+
+    @contextmanager
+    def span(self, function: str) -> Iterator[Span]:
+        """Times the block as a span, ending any spans started in it and
+        left open, as a stage that raised leaves them"""
+        self.start(function)
+        span = self._stack[-1]
+        try:
+            yield span
+        finally:
+            if span in self._stack:
+                while self._stack[-1] is not span:
+                    self.end(self._stack[-1].name)
+                self.end(function)
+
+    def record(self, rows: int = 0, nbytes: int = 0) -> None:
+        self._stack[-1].rows += rows
+        self._stack[-1].bytes += nbytes
+
+    def record_frame(self, df: pl.DataFrame) -> None:
+        self.record(len(df), df.estimated_size())
+
+    def finish(self) -> None:
+        """Ends any open spans and observes the whole task as the total stage"""
+        while len(self._stack) > 1:
+            self.end(self._stack[-1].name)
+        self._root.finish()
+        self._observe("total", self._root)
+
+    def _observe(self, stage: str, span: Span) -> None:
+        labels = {**self.labels, "stage": stage}
+        STAGE_SECONDS.labels(**labels).observe(span.time)
+        STAGE_RSS.labels(**labels).observe(span.rss)
+        STAGE_RSS_GROWTH.labels(**labels).observe(max(0, span.rss_growth))
+        if span.rows > 0:
+            STAGE_ROWS.labels(**labels).observe(span.rows)
+        if span.bytes > 0:
+            STAGE_BYTES.labels(**labels).observe(span.bytes)
+
+    @property
+    def get_times(self) -> Dict[str, Dict]:
+        return merge_spans(self._root.children)
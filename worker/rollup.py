@@ -0,0 +1,161 @@
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import polars as pl
+from pymongo import ReplaceOne
+from worker.aggregation import (CELL_COLUMNS, HOUSE_COLUMNS, MONTHLY_COLUMNS,
+                                decode_frame, encode_frame, house_increment,
+                                house_stats, merge_houses, merge_monthly,
+                                monthly_stats, stale_months)
+from worker.loader import SectorIncrementLoader, SectorLoader
+from worker.postcode_index import PostcodeIndex
+from worker.settings import Settings
+
+
+class Rollup():
+    """Builds the monthly state of an area by merging per sector states
+
+    Every sector keeps its sufficient statistics split by the cell columns in
+    the rollup collection, so any area which is a union of sectors, or of
+    parts of sectors for county, district and town, is a merge of small
+    tables instead of a load of every sale in it. Sector states are folded
+    into running totals of the area whenever the unmerged ones pass
+    memory_mb, so the whole country never holds every sector at once.
+
+    Like area states, sector states keep the cut-off they were built up to,
+    and once the data moves on the sales since it are folded in rather than
+    the sector being loaded again.
+    """
+    area_types = ["sector", "outcode", "area", "town", "district", "county", ""]
+    batch_size = 500
+
+    def __init__(self, db_cur, mongo, sql_uri: str, last_updated: datetime, memory_mb: int = 0) -> None:
+        self._cur = db_cur
+        self._mongo = mongo
+        self._sql_uri = sql_uri
+        self._last_updated = last_updated
+        self._max_bytes = memory_mb * 1024 * 1024
+
+    def get_state(self, area: str, area_type: str) -> Tuple[pl.DataFrame, pl.DataFrame]:
+        if area_type not in self.area_types:
+            raise ValueError("Invalid area type")
+        sectors = self._child_sectors(area, area_type)
+        if len(sectors) == 0:
+            raise RuntimeError("No Sales for this area")
+
+        self._area = area
+        self._area_type = area_type
+        self._monthly: List[pl.DataFrame] = []
+        self._houses: List[pl.DataFrame] = []
+        self._size = 0
+        missing = self._load_sector_states(sectors)
+        for i in range(0, len(missing), self.batch_size):
+            self._add(*self._build_sector_states(missing[i:i+self.batch_size]))
+        if len(self._monthly) == 0:
+            raise RuntimeError("No Sales for this area")
+
+        monthly, houses = self._fold()
+        self._monthly = []
+        self._houses = []
+        if len(monthly) == 0:
+            raise RuntimeError("No Sales for this area")
+        return monthly, houses
+
+    def _add(self, monthly: pl.DataFrame, houses: pl.DataFrame) -> None:
+        if self._area_type != "":
+            monthly = monthly.filter(pl.col(self._area_type) == self._area)
+            houses = houses.filter(pl.col(self._area_type) == self._area)
+        self._monthly.append(monthly.select(MONTHLY_COLUMNS))
+        self._houses.append(houses.select(HOUSE_COLUMNS))
+        self._size += self._monthly[-1].estimated_size() + self._houses[-1].estimated_size()
+        if self._max_bytes > 0 and self._size > self._max_bytes:
+            self._fold()
+
+    def _fold(self) -> Tuple[pl.DataFrame, pl.DataFrame]:
+        """Merges the states added so far into one running total"""
+        monthly = merge_monthly(pl.concat(self._monthly))
+        houses = merge_houses(pl.concat(self._houses))
+        self._monthly = [monthly]
+        self._houses = [houses]
+        self._size = monthly.estimated_size() + houses.estimated_size()
+        return monthly, houses
+
+    def _child_sectors(self, area: str, area_type: str) -> List[str]:
+        index = PostcodeIndex.get(self._cur)
+        if index is not None:
+            return index.children(area, area_type, "sector")
+        if area_type == "":
+            self._cur.execute("SELECT DISTINCT sector FROM postcodes WHERE sector IS NOT NULL;")
+        else:
+            self._cur.execute(f"SELECT DISTINCT sector FROM postcodes WHERE {area_type} = %s AND sector IS NOT NULL;", (area,))
+        return [row[0] for row in self._cur.fetchall()]
+
+    @property
+    def latest_date(self) -> datetime | None:
+        return Settings.latest_date(self._cur)
+
+    def _load_sector_states(self, sectors: List[str]) -> List[str]:
+        """Adds the states of the sectors, updating stale ones, and returns the sectors without one"""
+        found = set()
+        stale: Dict[datetime, List[str]] = {}
+        latest_date = self.latest_date
+        records = self._mongo.rollup.find({"_id": {"$in": sectors}})
+        for record in records:
+            if not set(HOUSE_COLUMNS) <= set(record["houses"]) or "cutoff" not in record:
+                continue
+            found.add(record["_id"])
+            if record["cutoff"] != latest_date or record["last_updated"] < self._last_updated:
+                stale.setdefault(record["cutoff"], []).append(record["_id"])
+            elif len(record["monthly"]["date"]) > 0:
+                self._add(decode_frame(record["monthly"]), decode_frame(record["houses"]))
+        for cutoff, stale_sectors in stale.items():
+            for i in range(0, len(stale_sectors), self.batch_size):
+                self._add(*self._update_sector_states(stale_sectors[i:i+self.batch_size], cutoff))
+        return [sector for sector in sectors if sector not in found]
+
+    def _build_sector_states(self, sectors: List[str]) -> Tuple[pl.DataFrame, pl.DataFrame]:
+        loader = SectorLoader(sectors, self._cur, self._sql_uri)
+        data = loader.get_data().sort("date")
+        monthly = monthly_stats(data, by=CELL_COLUMNS)
+        houses = house_stats(data, by=CELL_COLUMNS)
+        del data
+        self._write_sector_states(sectors, monthly, houses, loader.latest_date)
+        return monthly, houses
+
+    def _update_sector_states(self, sectors: List[str], cutoff: datetime) -> Tuple[pl.DataFrame, pl.DataFrame]:
+        """Folds the sales since cutoff into the states of the sectors, as Analyse.load_increment does for an area"""
+        loader = SectorIncrementLoader(sectors, self._cur, self._sql_uri, cutoff)
+        records = list(self._mongo.rollup.find({"_id": {"$in": sectors}}))
+        monthly = pl.concat([decode_frame(record["monthly"]) for record in records])
+        houses = pl.concat([decode_frame(record["houses"]) for record in records])
+        del records
+
+        months = stale_months(merge_monthly(monthly, by=["sector"]), loader.monthly_totals(), by=["sector"])
+        loader.fetch_area_sales(months)
+        data = loader.get_data().sort("date")
+        monthly = monthly.filter(~pl.col("date").is_in(months))
+        if len(data) > 0:
+            monthly = merge_monthly(pl.concat([monthly, monthly_stats(data, by=CELL_COLUMNS)]), by=CELL_COLUMNS)
+        if len(months) > 0:
+            houses = loader.house_totals()
+        elif len(data) > 0:
+            houses = merge_houses(pl.concat([houses, house_increment(data, by=CELL_COLUMNS)]), by=CELL_COLUMNS)
+        del data
+        self._write_sector_states(sectors, monthly, houses, loader.latest_date)
+        return monthly, houses
+
+    def _write_sector_states(self, sectors: List[str], monthly: pl.DataFrame, houses: pl.DataFrame,
+                             cutoff: datetime | None) -> None:
+        monthly_sectors = monthly.partition_by("sector", as_dict=True) if len(monthly) > 0 else {}
+        house_sectors = houses.partition_by("sector", as_dict=True) if len(houses) > 0 else {}
+        writes = [
+            ReplaceOne({"_id": sector}, {
+                "_id": sector,
+                "cutoff": cutoff,
+                "last_updated": datetime.now(),
+                "monthly": encode_frame(monthly_sectors.get(sector, monthly.clear())),
+                "houses": encode_frame(house_sectors.get(sector, houses.clear()))
+            }, upsert=True)
+                for sector in sectors
+        ]
+        self._mongo.rollup.bulk_write(writes, ordered=False)
@@ -0,0 +1,112 @@
+import time
+from typing import Dict, Tuple
+
+import psycopg2
+from worker.config import Config
+
+INTERACTIVE = "interactive"
+STANDARD = "celery"
+HEAVY = "heavy"
+MAINTENANCE = "maintenance"
+QUEUES = [INTERACTIVE, STANDARD, HEAVY]
+INTERACTIVE_TASKS = ["worker.valuation", "worker.valuation_callback"]
+MAINTENANCE_TASKS = ["worker.analyse_batch", "worker.analyse_areas", "worker.migrate_cache", "worker.build_snapshot"]
+AREA_TYPES = ["postcode", "street", "town", "district", "county", "outcode", "area", "sector"]
+INTERACTIVE_AREA_TYPES = ["postcode", "street", "sector"]
+
+
+class SizeEstimate():
+    """Per process cache of roughly how many sales each area has
+
+    An area's postcodes times the average sales of a postcode, or for the
+    whole country the planner's row count of sales, so an estimate costs an
+    index lookup. Estimates are kept for ttl seconds.
+    """
+    ttl = 3600
+    sales_per_postcode = Config.SALES_PER_POSTCODE
+    _values: Dict[str, Tuple[float, int]] = {}
+
+    @classmethod
+    def sales(cls, db_cur, area: str, area_type: str) -> int:
+        area = area.upper()
+        area_type = area_type.lower()
+        if area in ["", "ALL"] and area_type in ["", "country"]:
+            area = ""
+            area_type = ""
+        elif area_type not in AREA_TYPES:
+            raise ValueError("Invalid area type")
+        key = area + area_type
+        cached = cls._values.get(key)
+        if cached is not None and time.monotonic() - cached[0] < cls.ttl:
+            return cached[1]
+        if area_type == "":
+            db_cur.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = 'sales';")
+            sales = db_cur.fetchone()[0]
+        else:
+            db_cur.execute(f"SELECT COUNT(*) FROM postcodes WHERE {area_type} = %s;", (area,))
+            sales = int(db_cur.fetchone()[0] * cls.sales_per_postcode)
+        cls._values[key] = (time.monotonic(), sales)
+        return sales
+
+
+def size_queue(sales: int) -> str:
+    if sales <= Config.INTERACTIVE_MAX_SALES:
+        return INTERACTIVE
+    if sales >= Config.HEAVY_MIN_SALES:
+        return HEAVY
+    return STANDARD
+
+
+def priority(level: int) -> int:
+    """Message priority from 0 (lowest) to 9, which Redis takes lowest number first"""
+    if Config.CELERY_BROKER_URL.startswith(("redis://", "rediss://")):
+        return 9 - level
+    return level
+
+
+def analyse_queue(area: str, area_type: str) -> str:
+    """Queue of an analysis by its area type alone, so routing needs no database"""
+    if area.upper() == "ALL" and area_type.upper() == "COUNTRY":
+        return HEAVY
+    if area_type.lower() in INTERACTIVE_AREA_TYPES:
+        return INTERACTIVE
+    return STANDARD
+
+
+def larger_queue(db_cur, area: str, area_type: str, queue: str | None) -> str | None:
+    """Queue an analysis picked up from queue should move on to, by its
+    estimated sales, None if it is big enough for the one it is on"""
+    if queue not in QUEUES:
+        return None
+    try:
+        target = size_queue(SizeEstimate.sales(db_cur, area, area_type))
+    except (psycopg2.Error, ValueError) as e:
+        print(e)
+        return None
+    if QUEUES.index(target) > QUEUES.index(queue):
+        return target
+    return None
+
+
+def route_task(name: str, args: Tuple, kwargs: Dict, options: Dict, task=None, **_kwargs) -> Dict | None:
+    """Celery router sending each task to a queue by how much work it is
+
+    Valuations go to the interactive queue ahead of everything else, and
+    analyses by their area type, the whole country to the heavy queue, the
+    small ones interactive and the rest to celery, the default queue that
+    producers without these routes also send to. The worker then moves an
+    analysis its area's sales make too big for its queue with
+    larger_queue. Batch work, cache migrations and snapshot builds go to
+    the maintenance queue, so hours of it never hold up the country
+    analysis valuations wait on.
+    """
+    if name in INTERACTIVE_TASKS:
+        return {"queue": INTERACTIVE, "priority": priority(9)}
+    if name in MAINTENANCE_TASKS:
+        return {"queue": MAINTENANCE, "priority": priority(0)}
+    if name == "worker.analyse":
+        area = kwargs.get("area", args[0] if len(args) > 0 else "")
+        area_type = kwargs.get("area_type", args[1] if len(args) > 1 else "")
+        queue = analyse_queue(area, area_type)
+        return {"queue": queue, "priority": priority(6 if queue == INTERACTIVE else 3)}
+    return None
@@ -0,0 +1,50 @@
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Tuple
+
+from dateutil.relativedelta import relativedelta
+
+
+class Settings():
+    """Per process cache of the settings table
+
+    Values are kept for ttl seconds, so the many last_updated lookups of a
+    task, and of the tasks after it, cost one query between refreshes.
+    """
+    ttl = 60
+    _values: Dict[str, Tuple[float, str | None]] = {}
+
+    @classmethod
+    def get(cls, db_cur, name: str) -> str | None:
+        cached = cls._values.get(name)
+        if cached is not None and time.monotonic() - cached[0] < cls.ttl:
+            return cached[1]
+        db_cur.execute("SELECT data FROM settings WHERE name = %s;", (name,))
+        row = db_cur.fetchone()
+        value = row[0] if row is not None else None
+        cls._values[name] = (time.monotonic(), value)
+        return value
+
+    @classmethod
+    def invalidate(cls) -> None:
+        cls._values.clear()
+
+    @classmethod
+    def last_updated(cls, db_cur) -> datetime:
+        data = cls.get(db_cur, "last_updated")
+        if data is not None:
+            return datetime.fromtimestamp(float(data))
+        else:
+            return datetime.fromtimestamp(0)
+
+    @classmethod
+    def latest_date(cls, db_cur) -> datetime | None:
+        """Date sales are counted up to, two months back while data is fresh"""
+        latest_date = cls.get(db_cur, "last_updated")
+        if latest_date is not None:
+            latest_date = datetime.fromtimestamp(float(latest_date))
+            if latest_date > (datetime.now() - timedelta(days=60)):
+                start = datetime.now().replace(day=1).replace(hour=0,minute=0,second=0, microsecond=0)
+                return start - relativedelta(months=2)
+            else:
+                return latest_date
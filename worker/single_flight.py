@@ -0,0 +1,94 @@
+import threading
+import time
+import uuid
+
+from redis import Redis, RedisError
+from worker.config import Config
+
+RELEASE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+RENEW = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class SingleFlight():
+    """Redis lease on computing one key, so concurrent tasks do it once
+
+    The owner holds the key for lease seconds and renews it every third of
+    that from a background thread while it works. The others wait for the key
+    to go, by release or by the lease running out if the owner died, then
+    check for its result and if there is none try to take the lease
+    themselves. Without Redis every caller owns the key.
+    """
+    lease = Config.SINGLE_FLIGHT_LEASE
+    timeout = Config.SINGLE_FLIGHT_TIMEOUT
+    poll = 0.1
+    max_poll = 2.0
+
+    def __init__(self, redis: Redis | None, key: str) -> None:
+        self._redis = redis
+        self._key = f"single_flight:{key}"
+        self._token = uuid.uuid4().hex
+        self._owned = False
+        self._stop = threading.Event()
+        self._heartbeat: threading.Thread | None = None
+
+    def acquire(self) -> bool:
+        if self._redis is None:
+            return True
+        try:
+            self._owned = bool(self._redis.set(self._key, self._token, nx=True, px=int(self.lease * 1000)))
+        except RedisError as e:
+            print(e)
+            self._redis = None
+            return True
+        if self._owned:
+            self._stop.clear()
+            self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+            self._heartbeat.start()
+        return self._owned
+
+    def wait(self) -> bool:
+        """Waits up to timeout seconds for the key to be released, False if it timed out"""
+        if self._redis is None:
+            return True
+        deadline = time.monotonic() + self.timeout
+        poll = self.poll
+        while time.monotonic() < deadline:
+            try:
+                if not self._redis.exists(self._key):
+                    return True
+            except RedisError as e:
+                print(e)
+                self._redis = None
+                return True
+            time.sleep(poll)
+            poll = min(poll * 2, self.max_poll)
+        return False
+
+    def release(self) -> None:
+        if not self._owned:
+            return
+        self._stop.set()
+        self._heartbeat.join()
+        self._owned = False
+        try:
+            self._redis.eval(RELEASE, 1, self._key, self._token)
+        except RedisError as e:
+            print(e)
+
+    def _renew(self) -> None:
+        while not self._stop.wait(self.lease / 3):
+            try:
+                if not self._redis.eval(RENEW, 1, self._key, self._token, int(self.lease * 1000)):
+                    return
+            except RedisError as e:
+                print(e)
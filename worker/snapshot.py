@@ -0,0 +1,127 @@
+import os
+import shutil
+import time
+from datetime import datetime
+from typing import List, Set
+
+import polars as pl
+from worker.postcode_index import PostcodeIndex, postcode_areas
+
+from celery import current_app
+
+
+class Snapshot():
+    """On-disk copy of the joined sales table for one value of last_updated
+
+    The standard price sales of each postcode area are written to their own
+    uncompressed Arrow IPC file with the postcode hierarchy columns, so
+    loaders memory map only the files an area touches, filter them on the
+    area column while scanning, and share the page cache across workers.
+    It is built by the worker.build_snapshot task on the maintenance
+    queue, and loaders read from Postgres until it is ready.
+    """
+    columns = ["price", "date", "type", "houseid", "postcode", "street", "town",
+               "district", "county", "outcode", "area", "sector"]
+    lock_timeout = 4 * 60 * 60
+    _requested: Set[str] = set()
+
+    def __init__(self, directory: str, db_cur, sql_uri: str, last_updated: datetime) -> None:
+        self._directory = directory
+        self._cur = db_cur
+        self._sql_uri = sql_uri
+        self._name = str(int(last_updated.timestamp()))
+        self._path = os.path.join(directory, self._name)
+
+    @property
+    def ready(self) -> bool:
+        return os.path.isdir(self._path)
+
+    def request_build(self) -> None:
+        """Sends the task to build the snapshot, once per process"""
+        if self._path in Snapshot._requested:
+            return
+        Snapshot._requested.add(self._path)
+        try:
+            current_app.send_task("worker.build_snapshot")
+        except Exception as e:
+            print(e)
+
+    def build(self) -> None:
+        """Writes the snapshot unless it exists or another worker is writing it"""
+        if self.ready or not self._lock():
+            return
+        tmp = f"{self._path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(tmp, exist_ok=True)
+            for area in postcode_areas(self._cur):
+                self._fetch_area(area).write_ipc(os.path.join(tmp, f"{area}.arrow"))
+            os.rename(tmp, self._path)
+            self._remove_old()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.remove(self._lock_path)
+
+    def scan(self, area: str, area_type: str, before: datetime, columns: List[str] | None = None) -> pl.DataFrame:
+        columns = columns or ["price", "date", "type", "houseid"]
+        files = [os.path.join(self._path, f"{name}.arrow") for name in self._areas(area, area_type)]
+        files = [path for path in files if os.path.exists(path)]
+        if len(files) == 0:
+            return pl.DataFrame(schema={column: pl.Utf8 for column in columns}) \
+                .with_columns([pl.col("price").cast(pl.Int64), pl.col("date").cast(pl.Datetime("us"))])
+        data = pl.concat([pl.scan_ipc(path, memory_map=True) for path in files])
+        if area_type != "":
+            data = data.filter(pl.col(area_type) == area)
+        return data \
+            .filter(pl.col("date") < before) \
+            .select(columns) \
+            .collect()
+
+    def _areas(self, area: str, area_type: str) -> List[str]:
+        if area_type == "":
+            return [name[:-len(".arrow")] for name in os.listdir(self._path)]
+        elif area_type == "area":
+            return [area]
+        index = PostcodeIndex.get(self._cur) if area_type in PostcodeIndex.area_types else None
+        if index is not None:
+            return index.children(area, area_type, "area")
+        self._cur.execute(f"SELECT DISTINCT area FROM postcodes WHERE {area_type} = %s;", (area,))
+        return [row[0] for row in self._cur.fetchall() if row[0] is not None]
+
+    def _fetch_area(self, area: str) -> pl.DataFrame:
+        query = f"""SELECT s.price, s.date, h.type, h.houseid, p.postcode, p.street, p.town,
+                    p.district, p.county, p.outcode, p.area, p.sector
+                FROM postcodes AS p
+                INNER JOIN houses AS h ON p.postcode = h.postcode AND p.area = '{area}'
+                INNER JOIN sales AS s ON h.houseid = s.houseid AND h.type != 'O'
+                WHERE s.ppd_cat = 'A'
+                ORDER BY s.date
+                """
+        return pl.read_database(query, self._sql_uri) \
+            .with_columns([
+                pl.col("price").cast(pl.Int64),
+                pl.col("date").cast(pl.Datetime("us")),
+            ]) \
+            .select(self.columns)
+
+    @property
+    def _lock_path(self) -> str:
+        return f"{self._path}.lock"
+
+    def _lock(self) -> bool:
+        os.makedirs(self._directory, exist_ok=True)
+        try:
+            if time.time() - os.path.getmtime(self._lock_path) > self.lock_timeout:
+                os.remove(self._lock_path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(self._lock_path, os.O_CREAT | os.O_EXCL))
+            return True
+        except FileExistsError:
+            return False
+
+    def _remove_old(self) -> None:
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if name != self._name and name.isdigit() and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
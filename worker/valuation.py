@@ -1,88 +1,151 @@
 from datetime import datetime
 from typing import Dict, List, Tuple
 
-import psycopg2
-from pymongo import MongoClient
-from worker.config import Config
+import numpy as np
+from worker.aggregation_cache import AggregationCache
+from worker.cache_format import decode_price_index
+from worker.connections import Connections
+from worker.postcode_index import PostcodeIndex
+from worker.profiler import Profiler
+from worker.settings import Settings
+
+HOUSE_AREAS = ["town", "district", "county", "area", "outcode", "sector"]
 
 
 class Valuation():
-    def __init__(self) -> None:
-        config = Config()
-        self._sql_db = psycopg2.connect(f"postgresql://{config.SQL_USER}:{config.SQL_PASSWORD}@{config.SQL_HOST}:5432/house_data")
-        self._mongo_db = MongoClient(f"mongodb://{config.MONGO_USER}:{config.MONGO_PASSWORD}@{config.MONGO_HOST}:27017/?authSource=house_data")
+    def __init__(self, task: str = "valuation") -> None:
+        self._sql_db = Connections.get_sql()
+        self._mongo_db = Connections.mongo()
         self._cur = self._sql_db.cursor()
         self._mongo = self._mongo_db.house_data
+        self.timer = Profiler(task)
+
+    def clean_up(self):
+        self.timer.finish()
+        self._cur.close()
+        Connections.put_sql(self._sql_db)
 
     def check_house(self, houseid: str) -> bool:
-        self._cur.execute("""SELECT h.houseid, h.paon, h.saon, h.postcode, h.type, p.town, p.district, p.county, p.area, p.outcode, p.sector
-                              FROM houses AS h
-                              INNER JOIN postcodes AS p ON h.postcode = p.postcode AND h.houseid = %s;""", 
-                              (houseid,))
-        self._house_info = self._cur.fetchone()
+        self._house_info = self.check_houses([houseid]).get(houseid)
         if self._house_info is not None:
             return True
         else:
             return False
 
-    def get_areas(self) -> List[Tuple[str,str]]:
+    def check_houses(self, houseids: List[str]) -> Dict[str, Tuple]:
+        index = PostcodeIndex.get(self._cur)
+        if index is not None:
+            self._cur.execute("SELECT houseid, paon, saon, postcode, type FROM houses WHERE houseid = ANY(%s);",
+                              (list(houseids),))
+            houses = {}
+            for row in self._cur.fetchall():
+                areas = index.resolve(row[3])
+                if areas is not None:
+                    houses[row[0]] = row + tuple(areas[key] for key in HOUSE_AREAS)
+            return houses
+        self._cur.execute("""SELECT h.houseid, h.paon, h.saon, h.postcode, h.type, p.town, p.district, p.county, p.area, p.outcode, p.sector
+                              FROM houses AS h
+                              INNER JOIN postcodes AS p ON h.postcode = p.postcode AND h.houseid = ANY(%s);""",
+                              (list(houseids),))
+        return {row[0]: row for row in self._cur.fetchall()}
+
+    def get_areas(self, house_info: Tuple | None = None) -> List[Tuple[str,str]]:
+        house_info = house_info or self._house_info
         area_types = [("town", 5), ("county", 7), ("area", 8), ("outcode", 9), ("sector", 10)]
         areas = []
         for area_type in area_types:
             areas.append(
-                (self._house_info[area_type[1]], area_type[0])
+                (house_info[area_type[1]], area_type[0])
             )
         return areas
 
-    def load_aggregations(self, areas: List[Tuple[str,str]]) -> List[Dict]:
-        aggregations = []
+    def stale_areas(self, areas: List[Tuple[str,str]]) -> List[Tuple[str,str]]:
+        """Areas without a cached analysis as new as the latest data"""
+        AggregationCache.check(Settings.last_updated(self._cur))
+        ids = {"".join(area).upper(): area for area in areas}
+        ids = {_id: area for _id, area in ids.items() if not AggregationCache.contains(_id)}
+        if len(ids) == 0:
+            return []
+        fresh = self._mongo.cache.find({
+            "_id": {"$in": list(ids)},
+            "price_index": {"$exists": True},
+            "last_updated": {"$gte": Settings.last_updated(self._cur)}
+        }, {"_id": 1})
+        fresh = {record["_id"] for record in fresh}
+        return [area for _id, area in ids.items() if _id not in fresh]
+
+    def load_aggregations(self, areas: List[Tuple[str,str]], loaded: Dict[str, Dict] | None = None) -> List[Dict]:
         areas.append(("ALL", "COUNTRY"))
-        for area in areas:
-            _id = "".join(area).upper()
-            agg = self._mongo.cache.find_one({"_id": _id})
+        ids = ["".join(area).upper() for area in areas]
+        if loaded is None:
+            loaded = self.fetch_aggregations(ids, [self._house_info[4].upper()])
+        return [loaded[_id] for _id in ids if _id in loaded]
+
+    def fetch_aggregations(self, ids: List[str], house_types: List[str]) -> Dict[str, Dict]:
+        """The price index and monthly sales of house_types in each cached area, keyed by _id
+
+        Slices come from the process's AggregationCache where it has them and
+        the rest from one projected query.
+        """
+        last_updated = Settings.last_updated(self._cur)
+        AggregationCache.check(last_updated)
+        house_types = set(house_types) | {"all"}
+        aggregations = {}
+        misses = []
+        for _id in set(ids):
+            agg = AggregationCache.get(_id, house_types)
             if agg is not None:
-                aggregations.append(agg)
-        for idx, agg in enumerate(aggregations):
-            temp = {
+                aggregations[_id] = agg
+            else:
+                misses.append(_id)
+        self.timer.set_cache(len(misses) == 0)
+        if len(misses) == 0:
+            return aggregations
+
+        projection = {"area": 1, "area_type": 1, "last_updated": 1}
+        for house_type in house_types:
+            projection[f"price_index.index.{house_type}"] = 1
+            projection[f"price_index.qty.{house_type}"] = 1
+        records = self._mongo.cache.find({"_id": {"$in": misses}}, projection)
+        for agg in records:
+            price_index = decode_price_index(agg.get("price_index", {}))
+            aggregations[agg["_id"]] = {
                 "area": agg["area"],
                 "area_type": agg["area_type"],
-                "monthly_qty": agg["stats"]["monthly_qty"],
-                "monthly_perc": agg["stats"]["percentage_change"]
+                "index": price_index["index"],
+                "qty": price_index["qty"]
                 }
-            aggregations[idx] = temp
+            if agg["last_updated"] >= last_updated and "price_index" in agg:
+                AggregationCache.put(agg["_id"], aggregations[agg["_id"]], house_types)
         return aggregations
 
-    def _calc_biases(self, aggs, time_frame) ->List[Dict[str,float]]:
-        monthly_volume = []
-        biases: List[Dict[str, float]] = []
-        for month in range(time_frame):
-            month_biases = {}
-            month_qty = 0
-            for area in aggs[:-1]:
-                idx = area["monthly_qty"]["type"].index(self._house_info[4].upper())
-                month_qty += area["monthly_qty"]["qty"][idx][month]
-
-            for area in aggs[:-1]:
-                idx = area["monthly_qty"]["type"].index(self._house_info[4].upper())
-                area_qty = area["monthly_qty"]["qty"][idx][month]
-                month_biases[area["area_type"].upper()] = area_qty/month_qty
-            biases.append(month_biases)
-
-        return biases
-
-    def find_monthly_averages(self, aggs) -> List[float]:
-        perc_changes = []
-        time_frame = len(aggs[-1]["monthly_perc"]["all"]["date"])
-        biases = self._calc_biases(aggs, time_frame)
-        for month in range(time_frame):
-            local_average = 0
-            for area in aggs[:-1]:
-                local_average += area["monthly_perc"][self._house_info[4].upper()]["perc_change"][month] * biases[month][area["area_type"]]
-            national_average = aggs[-1]["monthly_perc"][self._house_info[4].upper()]["perc_change"][month]
-            average = (local_average + national_average) / 2
-            perc_changes.append(average)
+    def _calc_biases(self, aggs, time_frame) -> np.ndarray:
+        """Share of each local area in the monthly sales of the house's type, areas x months"""
+        house_type = self._house_info[4].upper()
+        qtys = np.zeros((len(aggs) - 1, time_frame))
+        for idx, area in enumerate(aggs[:-1]):
+            qty = area["qty"].get(house_type, [])[:time_frame]
+            qtys[idx, :len(qty)] = qty
+        month_qty = qtys.sum(axis=0)
+        return np.divide(qtys, month_qty, out=np.zeros_like(qtys), where=month_qty > 0)
 
-        return perc_changes
+    def _growth(self, area, time_frame) -> np.ndarray:
+        """Month on month growth of the house's type, index[m + 1] / index[m]"""
+        growth = np.ones(time_frame)
+        index = np.asarray(area["index"].get(self._house_info[4].upper(), []), dtype=float)[:time_frame + 1]
+        if len(index) > 1:
+            growth[:len(index) - 1] = np.divide(index[1:], index[:-1], out=np.ones(len(index) - 1), where=index[:-1] != 0)
+        return growth
+
+    def find_house_index(self, aggs) -> np.ndarray:
+        """Price index of the house, the mean of the national index and its areas' indices
+        weighted by their sales of the house's type"""
+        time_frame = len(aggs[-1]["index"]["all"]) - 1
+        biases = self._calc_biases(aggs, time_frame)
+        local_growth = np.array([self._growth(area, time_frame) for area in aggs[:-1]]).reshape(biases.shape)
+        national_growth = self._growth(aggs[-1], time_frame)
+        local_growth = np.where(biases.sum(axis=0) > 0, (local_growth * biases).sum(axis=0), national_growth)
+        return np.concatenate(([1.0], np.cumprod((local_growth + national_growth) / 2)))
 
     def get_house_sales(self) -> List[Tuple[int, datetime]]:
         query = """SELECT s.price, s.date 
@@ -93,18 +156,62 @@ class Valuation():
         sales = self._cur.fetchall()
         return sales
 
-    def calc_latest_price(self, sales: List[Tuple[int, datetime]], percs: List[float]) -> List[List[datetime] | List[List[int]]]:
+    def get_houses_sales(self, houseids: List[str]) -> Dict[str, List[Tuple[int, datetime]]]:
+        query = """SELECT h.houseid, s.price, s.date
+                FROM houses AS h
+                INNER JOIN sales AS s on s.houseid = h.houseid AND h.houseid = ANY(%s)
+                WHERE s.freehold = true AND s.ppd_cat = 'A';"""
+        self._cur.execute(query, (list(houseids),))
+        sales = {houseid: [] for houseid in houseids}
+        for houseid, price, date in self._cur.fetchall():
+            sales[houseid].append((price, date))
+        return sales
+
+    def calc_latest_price(self, sales: List[Tuple[int, datetime]], index: np.ndarray) -> List[List[datetime] | List[List[int]]]:
         sales_valuations = []
-        for sale in sales:
-            sales_date = sale[1]
+        for price, sales_date in sales:
             sale_month = (sales_date.year - 1996) * 12 + sales_date.month - 1
-            house_value = []
-            prev_month = sale[0]
-            for month in percs[sale_month:]:
-                house_value.append(prev_month)
-                prev_month = prev_month * (1 + (month/100))
+            start = slice(sale_month, None).indices(len(index) - 1)[0]
+            house_value = np.round(price * index[start:-1] / index[start], -2)
             padding = [None for i in range(sale_month)]
-            house_value = list(map(lambda x: round(x,-2), house_value))
-            house_value = padding + house_value
-            sales_valuations.append(house_value)
-        return [[i[1] for i in sales],sales_valuations]
\ No newline at end of file
+            sales_valuations.append(padding + house_value.tolist())
+        return [[i[1] for i in sales],sales_valuations]
+
+    def calculate_range(self, valuations: List[List[datetime] | List[List[int]]]) -> List[int] | None:
+        """Lowest and highest of the current values implied by each past sale"""
+        latest = [values[-1] for values in valuations[1] if len(values) > 0 and values[-1] is not None]
+        if len(latest) == 0:
+            return None
+        return [min(latest), max(latest)]
+
+    def value_houses(self, houses: Dict[str, Tuple]) -> Dict[str, Dict]:
+        """Valuations of many houses, from check_houses
+
+        Houses sharing all their areas and their type share a price index,
+        so each is worked out once per group and every
+        aggregation is loaded once for the whole batch.
+        """
+        groups: Dict[Tuple, List[str]] = {}
+        for houseid, house_info in houses.items():
+            key = tuple(self.get_areas(house_info)) + (house_info[4].upper(),)
+            groups.setdefault(key, []).append(houseid)
+        ids = {"".join(area).upper() for key in groups for area in key[:-1]}
+        house_types = [key[-1] for key in groups]
+        with self.timer.span("load_aggregations"):
+            loaded = self.fetch_aggregations(list(ids) + ["ALLCOUNTRY"], house_types)
+        with self.timer.span("load_sales"):
+            sales = self.get_houses_sales(list(houses))
+            self.timer.record(rows=sum(len(house_sales) for house_sales in sales.values()))
+        results = {}
+        for key, group in groups.items():
+            self._house_info = houses[group[0]]
+            with self.timer.span("house_index"):
+                aggs = self.load_aggregations(list(key[:-1]), loaded)
+                index = self.find_house_index(aggs)
+            with self.timer.span("value"):
+                for houseid in group:
+                    valuations = self.calc_latest_price(sales[houseid], index)
+                    results[houseid] = {
+                        "price_range": self.calculate_range(valuations),
+                    }
+        return results